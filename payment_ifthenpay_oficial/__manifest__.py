@@ -15,22 +15,39 @@ For details, refer to our Privacy Policy: https://ifthenpay.com/politica-de-priv
     'website': "https://ifthenpay.com/",
     'depends': [
         'payment',
+        'bus',
         'website',
         'website_sale',
         'account',
         'account_payment',
     ],
     'data': [
+        'security/ir.model.access.csv',
         'views/payment_form_templates.xml',
+        # the provider form links to the actions of these views
+        'views/payment_ifthenpay_notification_views.xml',
+        'views/payment_ifthenpay_circuit_views.xml',
+        'views/payment_ifthenpay_metric_views.xml',
         'views/payment_provider_views.xml',
         'views/payment_method_templates.xml',
-        'views/payment_completed.xml',
+        'views/payment_ifthenpay_link_batch_views.xml',
+        'wizards/payment_ifthenpay_settlement_import_views.xml',
+        'views/payment_ifthenpay_settlement_views.xml',
+        'wizards/payment_ifthenpay_transaction_export_views.xml',
         'data/payment_method_data.xml',
         'data/payment_provider_data.xml',
+        'data/ir_cron_data.xml',
     ],
     'assets': {
         'web.assets_frontend': [
-            'payment_ifthenpay_oficial/static/src/**/*',
+            'payment_ifthenpay_oficial/static/src/js/ifthenpay_checkout.js',
+            'payment_ifthenpay_oficial/static/src/js/ifthenpay_loader.js',
+        ],
+        # loaded on demand by ifthenpay_loader.js when ifthenpay is selected
+        'payment_ifthenpay_oficial.assets_checkout': [
+            'payment_ifthenpay_oficial/static/src/css/ifthenpay.css',
+            'payment_ifthenpay_oficial/static/src/xml/ifthenpay_checkout_modal.xml',
+            'payment_ifthenpay_oficial/static/src/js/payment_form.js',
         ],
     },
     'post_init_hook': 'post_init_hook',
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from odoo.addons.payment_ifthenpay_oficial import metrics
+
+_logger = logging.getLogger(__name__)
+
+# Connections kept alive per host, shared by all the threads of a worker process.
+POOL_MAXSIZE = 16
+
+# Gateway errors that are worth retrying on idempotent calls.
+RETRY_STATUSES = (502, 503, 504)
+
+# Exponential backoff, in seconds: the n-th retry waits a random delay in [0, BACKOFF_BASE * 2**n].
+BACKOFF_BASE = 0.2
+BACKOFF_MAX = 5.0
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """ Raised instead of sending a request to an endpoint whose circuit breaker is open. """
+
+
+def is_failure(result):
+    """ Return whether the outcome of a request means that the endpoint is unavailable.
+
+    :param result: The response of the request, or the transport error it raised.
+    :return: Whether the request timed out, could not connect or got a server error.
+    :rtype: bool
+    """
+    if isinstance(result, CircuitOpenError):
+        return False
+    if isinstance(result, Exception):
+        return True
+    return result.status_code >= 500
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """ Return the HTTP session of the current process.
+
+    The session is created lazily and recreated after a fork so that prefork workers never share
+    sockets with their parent.
+
+    :return: The pooled session.
+    :rtype: requests.Session
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_MAXSIZE, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session, _session_pid = session, pid
+    return _session
+
+
+def request(endpoint, method, url, timeout, idempotent=False, max_retries=0, **kwargs):
+    """ Send a request through the pooled session.
+
+    Connection errors, timeouts and gateway errors are retried with exponential backoff and full
+    jitter, but only for idempotent calls. The duration of the call, retries included, is recorded
+    in the `api` histogram by endpoint and HTTP status or error.
+
+    :param str endpoint: The name of the endpoint, used for logging and metrics.
+    :param str method: The HTTP method.
+    :param str url: The full URL.
+    :param float timeout: The timeout of each attempt, in seconds.
+    :param bool idempotent: Whether the call can safely be sent more than once.
+    :param int max_retries: The maximum number of retries of an idempotent call.
+    :return: The response of the last attempt.
+    :rtype: requests.Response
+    :raise requests.exceptions.RequestException: If the last attempt failed at transport level.
+    """
+    started = time.perf_counter()
+    try:
+        response = _request_with_retries(endpoint, method, url, timeout, max_retries if idempotent else 0, **kwargs)
+    except requests.exceptions.Timeout:
+        metrics.observe('api', endpoint, 'timeout', time.perf_counter() - started)
+        raise
+    except requests.exceptions.RequestException:
+        metrics.observe('api', endpoint, 'connection_error', time.perf_counter() - started)
+        raise
+    metrics.observe('api', endpoint, response.status_code, time.perf_counter() - started)
+    return response
+
+
+def _request_with_retries(endpoint, method, url, timeout, max_retries, **kwargs):
+    attempt = 0
+    while True:
+        try:
+            response = get_session().request(method, url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt >= max_retries:
+                raise
+            _logger.info("ifthenpay: %s request failed (%s), retry %s/%s.", endpoint, e, attempt + 1, max_retries)
+        else:
+            if attempt >= max_retries or response.status_code not in RETRY_STATUSES:
+                return response
+            _logger.info(
+                "ifthenpay: %s request returned %s, retry %s/%s.",
+                endpoint, response.status_code, attempt + 1, max_retries,
+            )
+        time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+        attempt += 1
+
+
+def request_many(requests_kwargs, max_workers):
+    """ Send several requests concurrently through the pooled session.
+
+    :param list requests_kwargs: The keyword arguments of `request`, one dict per request.
+    :param int max_workers: The maximum number of requests in flight, capped to the pool size.
+    :return: For each request, in order, its response or the transport error it raised.
+    :rtype: list
+    """
+    def send(kwargs):
+        try:
+            return request(**kwargs)
+        except requests.exceptions.RequestException as e:
+            return e
+
+    if not requests_kwargs:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, POOL_MAXSIZE))) as executor:
+        return list(executor.map(send, requests_kwargs))
@@ -4,6 +4,53 @@ SUPPORTED_CURRENCIES = (
     'EUR',
 )
 
+API_BASE_URL = 'https://api.ifthenpay.com'
+
+# Static page the gateway sends the customer back to; it hands the parameters over to the checkout.
+RETURN_PAGE_PATH = '/payment_ifthenpay_oficial/static/src/html/ifthenpay_return.html'
+
+# Outbound API endpoints: (HTTP method, path, whether the call is idempotent and can be retried).
+API_ENDPOINTS = {
+    'integration': ('POST', '/v2/cmsintegration/get/{token}/odoo', True),
+    'pinpay': ('POST', '/gateway/pinpay/{gateway_key}', False),
+    'status': ('GET', '/gateway/transaction/status/get', True),
+    'methods': ('GET', '/gateway/methods/available', True),
+    'callback_activation': ('POST', '/endpoint/callback/activation/', True),
+}
+
+# Default timeouts of the outbound API endpoints, in seconds.
+DEFAULT_API_TIMEOUTS = {
+    'integration': 60,
+    'pinpay': 30,
+    'status': 30,
+    'methods': 10,
+    'callback_activation': 30,
+}
+
+# Validity of a Pinpay payment link, in days, when the integration does not set `expiryDays`.
+PINPAY_DEFAULT_EXPIRY_DAYS = 1
+
+# Payment method icons are stored as attachments; those up to this size (in bytes) are also
+# inlined as data URIs in the list of payment methods sent to the checkout.
+METHOD_ICON_INLINE_MAX_SIZE = 16 * 1024
+
+# The icons are downloaded concurrently, with a short timeout and no retry, behind the circuit
+# breaker of the `method_icon` endpoint; an icon that failed is not tried again for
+# METHOD_ICON_RETRY_DELAY seconds.
+METHOD_ICON_TIMEOUT = 3
+METHOD_ICON_MAX_WORKERS = 4
+METHOD_ICON_RETRY_DELAY = 600
+
+# Gateway payment methods whose result is final when the customer returns from the gateway, and
+# whose status is therefore fetched from the API instead of waiting for the callback.
+STATUS_POLL_PAYMENT_METHODS = ('CCARD', 'APPLE', 'GOOGLE')
+
+# Status polling of the gateway transactions: attempts, and the delay before the n-th attempt
+# (STATUS_POLL_BASE_DELAY * 2**n seconds, capped to STATUS_POLL_MAX_DELAY).
+STATUS_POLL_MAX_ATTEMPTS = 10
+STATUS_POLL_BASE_DELAY = 2
+STATUS_POLL_MAX_DELAY = 300
+
 DEFAULT_PAYMENT_METHOD_CODES = {
     # Primary payment methods.
     'ifthenpay',
@@ -33,3 +80,16 @@ HANDLED_WEBHOOK_EVENTS = [
     'CHECKOUT.ORDER.APPROVED',
     'CHECKOUT.PAYMENT-APPROVAL.REVERSED',
 ]
+
+# Columns of the ifthenpay settlement (movements) exports, by the normalized header names they are
+# found under: lowercase, without accents.
+SETTLEMENT_COLUMNS = {
+    'reference': ('reference', 'referencia', 'order id', 'id encomenda', 'id pedido'),
+    'amount': ('amount', 'valor', 'montante', 'valor pago'),
+    'payment_date': ('date', 'data', 'payment date', 'data pagamento', 'data do pagamento'),
+    'payment_method': ('method', 'payment method', 'metodo', 'metodo de pagamento', 'meio de pagamento'),
+    'gateway_txid': ('transaction id', 'txid', 'id transacao', 'id da transacao'),
+}
+
+# Fields of the providers that change which ifthenpay provider serves a website or a company.
+PROVIDER_RESOLUTION_FIELDS = {'code', 'state', 'company_id', 'website_id', 'sequence', 'is_published'}
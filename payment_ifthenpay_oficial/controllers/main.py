@@ -1,46 +1,88 @@
 # -*- coding: utf-8 -*-
+import functools
+import hashlib
 import logging
+import time
 import werkzeug # Para redirecionamentos
-from werkzeug.exceptions import BadRequest
-from odoo import http
-from odoo.http import request
-import requests
+from werkzeug.exceptions import BadRequest, Forbidden, NotFound
+from odoo import fields, http
+from odoo.exceptions import UserError
+from odoo.http import content_disposition, request, Response
+from odoo.tools import consteq
 from odoo.tools.translate import _
 
+from odoo.addons.payment_ifthenpay_oficial import const, metrics
+
 _logger = logging.getLogger(__name__)
 
+
+def instrumented(route_name):
+    """ Record the duration and the SQL queries of the decorated route in the `route` histograms.
+
+    The result is the HTTP status of the response, `rate_limited` or `error` for a JSON answer
+    refusing the request or holding an error, or `exception`.
+
+    :param str route_name: The name of the route in the metrics.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            started, queries = time.perf_counter(), request.env.cr.sql_log_count
+            result = 'ok'
+            try:
+                response = func(self, *args, **kwargs)
+                if isinstance(response, dict) and response.get('rate_limited'):
+                    result = 'rate_limited'
+                elif isinstance(response, dict) and response.get('error'):
+                    result = 'error'
+                elif hasattr(response, 'status_code'):
+                    result = response.status_code
+                return response
+            except Exception:
+                result = 'exception'
+                raise
+            finally:
+                metrics.observe('route', route_name, result, time.perf_counter() - started)
+                metrics.observe('route_queries', route_name, result, request.env.cr.sql_log_count - queries)
+                request.env['payment.ifthenpay.metric'].sudo()._flush()
+        return wrapper
+    return decorator
+
+
 class IfthenpayController(http.Controller):
 
     @http.route('/payment/ifthenpay/submit_payment', type='json', auth='public', csrf=False, website=True)
+    @instrumented('submit_payment')
     def submit_payment(self, provider_id, method_code=None, tx_reference=None, extra_data=None):
         
-        provider = request.env['payment.provider'].sudo().browse(int(provider_id))
-
-        if not provider or provider.code != 'ifthenpay':
+        # only the providers serving the current website are accepted, resolved from the cache
+        provider_ids = self._ifthenpay_get_public_provider_ids()
+        if int(provider_id) not in provider_ids:
             _logger.error("ifthenpay: Provedor de pagamento invalido ou nao ifthenpay: %s", provider_id)
             return {'error': 'Provedor de pagamento invalido.'}
+        provider = request.env['payment.provider'].sudo().browse(int(provider_id))
+
+        retry_after = self._ifthenpay_check_rate_limit('submit_payment', provider)
+        if retry_after:
+            return self._ifthenpay_rate_limited_result(retry_after)
 
         tx_reference = extra_data.get('reference') if extra_data else tx_reference
         method_code = extra_data.get('method') if extra_data else method_code
 
-        tx = request.env['payment.transaction'].sudo().search([
-            ('reference', '=', tx_reference),
-            ('provider_code', '=', 'ifthenpay')
-        ], limit=1)
+        tx = request.env['payment.transaction']._ifthenpay_get_tx_by_reference(tx_reference)
 
-        if not tx:
+        if not tx or tx.provider_id != provider:
             _logger.error("ifthenpay: Transacao nao encontrada para referencia %s", tx_reference)
             return {'error': 'Transacao nao encontrada.'}
 
         if method_code == 'ifthenpay' or not method_code:
             try:
-                api_response = provider._ifthenpay_api_create_payment_pinpay(tx)
-                redirect_url = api_response.get('payment_url')
+                redirect_url = tx._ifthenpay_get_pinpay_url()
 
                 if not redirect_url:
                     raise Exception("URL de pagamento nao retornada pela ifthenpay.")
 
-                return {'redirect_url': redirect_url}
+                return {'redirect_url': redirect_url, 'bus_channel': tx._ifthenpay_get_bus_channel()}
             except Exception as e:
                 _logger.exception("ifthenpay: Erro ao obter URL de pagamento externo para tx %s: %s", tx_reference, e)
                 return {'error': str(e)}
@@ -48,56 +90,175 @@ class IfthenpayController(http.Controller):
             _logger.warning("ifthenpay: Metodo de pagamento nao suportado: %s", method_code)
             return {'error': 'Metodo de pagamento nao suportado.'}
     
-    @http.route('/payment/ifthenpay/get_payment_methods_icons', type='json', auth='public', website=True)
+    @http.route('/payment/ifthenpay/get_payment_methods_icons', type='http', auth='public', methods=['GET'], website=True)
+    @instrumented('get_payment_methods_icons')
     def ifthenpay_get_payment_methods_icons(self):
-        provider = request.env['payment.provider'].sudo().search([('code', '=', 'ifthenpay')], limit=1)
+        provider = self._ifthenpay_get_public_provider()
+
+        retry_after = provider and self._ifthenpay_check_rate_limit('get_payment_methods_icons', provider)
+        if retry_after:
+            return request.make_json_response(
+                self._ifthenpay_rate_limited_result(retry_after),
+                headers=[('Retry-After', str(retry_after)), ('Cache-Control', 'no-store')],
+                status=429,
+            )
 
         if not provider or not provider.ifthenpay_api_key:
             _logger.warning("NOT PROVIDER")
-            return {'error': 'API Key for ifthenpay not configured.'}
-
-        integration = provider._get_integration_api(provider.ifthenpay_api_key)
-        if integration is None:
-            _logger.warning("NONE INTEGRATION")
-            return  {'error': 'Provider disable.'}
-        
-        url = f'https://api.ifthenpay.com/gateway/methods/available'
-
-        accounts = integration.get('accountKeys')
+            return self._ifthenpay_json_response({'error': 'API Key for ifthenpay not configured.'})
 
-        cleaned_lines = []
-        for part in accounts.split(";"):
-            cleaned_lines.append(part.strip()) 
-
-        entidades = [item.split("|")[0] for item in cleaned_lines]
-        entidades = [e.upper() for e in entidades]
-        tem_numerico = any(e.isdigit() for e in entidades)
+        try:
+            methods = provider._ifthenpay_get_available_methods()
+        except UserError as e:
+            return self._ifthenpay_json_response({'error': str(e)})
 
+        if methods is None:
+            _logger.warning("NONE INTEGRATION")
+            return self._ifthenpay_json_response({'error': 'Provider disable.'})
+
+        # the list only changes when the cache of the provider is refreshed, let browsers and proxies keep it
+        return self._ifthenpay_json_response(
+            {'success': True, 'data': methods}, max_age=provider.ifthenpay_methods_refresh_interval,
+        )
+
+    @http.route('/payment/ifthenpay/method_icon/<int:attachment_id>/<string:checksum>', type='http', auth='public', methods=['GET'])
+    def ifthenpay_method_icon(self, attachment_id, checksum):
+        attachment = request.env['ir.attachment'].sudo().browse(attachment_id).exists()
+        # the checksum is part of the URL, so the content behind it never changes
+        if (
+            not attachment
+            or attachment.res_model != 'payment.provider'
+            or not attachment.name.startswith('ifthenpay_icon_')
+            or attachment.checksum != checksum
+        ):
+            raise NotFound()
+        return request.env['ir.binary']._get_stream_from(attachment).get_response(immutable=True)
+
+    @http.route('/payment/ifthenpay/metrics', type='http', auth='public', methods=['GET'])
+    def ifthenpay_metrics(self, token=None):
+        expected = request.env['ir.config_parameter'].sudo().get_param('payment_ifthenpay_oficial.metrics_token')
+        authorization = request.httprequest.headers.get('Authorization', '')
+        provided = authorization[len('Bearer '):] if authorization.startswith('Bearer ') else token
+        if not expected or not provided or not consteq(expected, provided):
+            raise NotFound()
+        return request.make_response(
+            request.env['payment.ifthenpay.metric'].sudo()._render_prometheus(),
+            headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'), ('Cache-Control', 'no-store')],
+        )
+
+    @http.route('/payment/ifthenpay/transactions/export', type='http', auth='user', methods=['GET'])
+    def ifthenpay_export_transactions(self, date_from=None, date_to=None, states=None, methods=None, **kwargs):
+        """ Stream the ifthenpay transactions of the current companies as a CSV file.
+
+        :param str date_from: The first creation date to export, as `YYYY-MM-DD`.
+        :param str date_to: The last creation date to export, as `YYYY-MM-DD`.
+        :param str states: The comma-separated states of the transactions to export.
+        :param str methods: The comma-separated codes of the payment methods to export.
+        """
+        user = request.env.user
+        if not (user.has_group('account.group_account_invoice') or user.has_group('base.group_system')):
+            raise Forbidden()
+        Transaction = request.env['payment.transaction']
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-
-            if isinstance(data, list):
-                data_filter = [
-                    m for m in data
-                    if m.get("Entity", "").upper() in entidades
-                    or (tem_numerico and m.get("Entity", "").upper() == "MB")
-                ]
-                return {'success': True, 'data': data_filter}
-            else:
-                return {'error': 'Invalid API response from ifthenpay.', 'details': data}
-
-        except requests.exceptions.RequestException as e:
-            return {'error': f'Failed to connect to ifthenpay API: {e}'}
-        except json.JSONDecodeError:
-            return {'error': 'Invalid JSON response from ifthenpay API.'}
+            date_from = fields.Date.to_date(date_from or None)
+            date_to = fields.Date.to_date(date_to or None)
+        except ValueError:
+            raise BadRequest("Invalid date.")
+        states = [state for state in (states or '').split(',') if state]
+        if set(states) - set(Transaction._fields['state'].get_values(request.env)):
+            raise BadRequest("Invalid state.")
+        payment_methods = request.env['payment.method']
+        if methods:
+            payment_methods = payment_methods.sudo().with_context(active_test=False).search([
+                ('code', 'in', methods.split(',')),
+            ])
+
+        filename = f"ifthenpay_transactions_{fields.Date.context_today(user)}.csv"
+        return Response(
+            Transaction._ifthenpay_export_csv(date_from, date_to, states, payment_methods),
+            headers=[
+                ('Content-Type', 'text/csv; charset=utf-8'),
+                ('Content-Disposition', content_disposition(filename)),
+                ('Cache-Control', 'no-store'),
+            ],
+            direct_passthrough=True,
+        )
+
+    def _ifthenpay_get_public_provider_ids(self):
+        """ Return the ifthenpay providers of the current website, or of the current company outside of one.
+
+        :return: The ids of the providers, the preferred one first.
+        :rtype: tuple
+        """
+        website = getattr(request, 'website', None)
+        company = website.company_id if website else request.env.company
+        return request.env['payment.provider']._ifthenpay_get_provider_ids(website.id if website else False, company.id)
+
+    def _ifthenpay_get_public_provider(self):
+        return request.env['payment.provider'].sudo().browse(self._ifthenpay_get_public_provider_ids()[:1])
+
+    def _ifthenpay_check_rate_limit(self, route, provider):
+        """ Take a token from the buckets of the visitor and of its IP address for the route.
+
+        :param str route: The name of the route.
+        :param recordset provider: The `payment.provider` holding the limits.
+        :return: 0 if the request is accepted, otherwise the seconds to wait before the next one.
+        :rtype: int
+        """
+        provider = provider.sudo()
+        burst = provider.ifthenpay_rate_limit_burst
+        buckets = []
+        remote_addr = request.httprequest.remote_addr
+        if remote_addr and provider.ifthenpay_rate_limit_ip > 0:
+            buckets.append((f'{route}:ip:{remote_addr}', burst, provider.ifthenpay_rate_limit_ip))
+        if request.session.sid and provider.ifthenpay_rate_limit_session > 0:
+            # the session id is a credential, only a digest of it is stored
+            session_key = hashlib.sha256(request.session.sid.encode()).hexdigest()[:32]
+            buckets.append((f'{route}:session:{session_key}', burst, provider.ifthenpay_rate_limit_session))
+        if not buckets:
+            return 0
+        retry_after = request.env['payment.ifthenpay.rate.limit'].sudo()._consume(buckets)
+        if retry_after:
+            _logger.debug("ifthenpay: %s rate limited for %s.", route, remote_addr)
+        return retry_after
+
+    def _ifthenpay_rate_limited_result(self, retry_after):
+        return {
+            'error': _("Too many requests. Please try again in %s seconds.", retry_after),
+            'rate_limited': True,
+            'retry_after': retry_after,
+        }
+
+    def _ifthenpay_json_response(self, data, max_age=0):
+        """ Return a JSON response, cacheable for `max_age` seconds and validated with an ETag.
+
+        :param dict data: The data to serialize.
+        :param int max_age: How long the response may be cached, in seconds. 0 disables caching.
+        :return: The response, or a `304 Not Modified` one if the client already has it.
+        :rtype: odoo.http.Response
+        """
+        response = request.make_json_response(data)
+        if max_age > 0:
+            response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+            response.make_conditional(request.httprequest)
+        else:
+            response.cache_control.no_store = True
+        return response
 
     # NOVA ROTA: Para a ifthenpay enviar o status de volta para o Odoo (Webhook / Notificacao)
     @http.route('/payment/ifthenpay/s2s_callback', type='http', auth='public', website=True, csrf=False)
+    @instrumented('s2s_callback')
     def ifthenpay_s2s_callback(self, **get_params):
+        provider = request.env['payment.provider'].sudo()._ifthenpay_get_provider_from_apk(get_params.get('apk'))
+        if not provider:
+            _logger.warning("ifthenpay_s2s_callback: Token invalido para a referencia %s.", get_params.get('reference'))
+            raise Forbidden()
+
+        # the callback is only stored here and processed by a cron job so that ifthenpay gets its answer right away
         try:
-            request.env['payment.transaction'].sudo()._handle_notification_data('ifthenpay', get_params)
+            request.env['payment.ifthenpay.notification'].sudo()._enqueue(provider, get_params)
             return "OK"
 
         except Exception as e:
@@ -105,108 +266,69 @@ class IfthenpayController(http.Controller):
             raise BadRequest("Error: Internal server error")
 
     @http.route('/payment/ifthenpay/check_transaction_status', type='json', auth='public', website=True, csrf=False)
+    @instrumented('check_transaction_status')
     def ifthenpay_check_transaction_status(self, tx_reference, **kwargs):
-        tx = request.env['payment.transaction'].sudo().search([('reference', '=', tx_reference)], limit=1)
+        provider = self._ifthenpay_get_public_provider()
+        retry_after = provider and self._ifthenpay_check_rate_limit('check_transaction_status', provider)
+        if retry_after:
+            return self._ifthenpay_rate_limited_result(retry_after)
+
+        tx = request.env['payment.transaction']._ifthenpay_get_tx_by_reference(tx_reference)
         
         if not tx:
             _logger.warning("ifthenpay_check_transaction_status: Transacao Odoo nao encontrada para referencia %s.", tx_reference)
             return {'status': 'error', 'message': 'Transaction not found.'}
 
-        if tx.state == 'done':
-            return {'status': 'success'}
-        elif tx.state == 'pending':
-            return {'status': 'pending'}
-        elif tx.state == 'cancel':
-            return {'status': 'error', 'message': 'Pagamento cancelado.'}
-        elif tx.state == 'error':
-            return {'status': 'error', 'message': 'Erro no pagamento.'}
-        else: # draft, authorized, etc. - assume que não foi concluído ainda
-            return {'status': 'processing', 'message': 'Aguardando confirmacao do pagamento.'}
-
-    @http.route('/payment/ifthenpay/iframe_redirect', type='http', auth='public', website=True, csrf=False)
-    def ifthenpay_iframe_redirect(self, **get_params):
-        _logger.info("iframe_redirect recebido (dados): %s", get_params)
-        return request.render('payment_ifthenpay_oficial.ifthenpay_iframe_redirect_template', {'params': get_params})
+        return tx._ifthenpay_get_checkout_status()
 
+    # Return URL of the payment links created before the static return page; kept for those links
+    @http.route('/payment/ifthenpay/iframe_redirect', type='http', auth='none', csrf=False, save_session=False)
+    def ifthenpay_iframe_redirect(self, **get_params):
+        query_string = request.httprequest.query_string.decode()
+        return werkzeug.utils.redirect(f"{const.RETURN_PAGE_PATH}?{query_string}", code=301)
 
-    @http.route('/payment/ifthenpay/iframe_callback', type='http', auth='public', website=True, csrf=False)
+    # the only dynamic request of the return from the gateway: the static return page sends its parameters here
+    @http.route('/payment/ifthenpay/iframe_callback', type='http', auth='public', methods=['GET'], csrf=False)
+    @instrumented('iframe_callback')
     def ifthenpay_iframe_callback(self, **get_params):
         odoo_tx_reference = get_params.get('reference')
         odoo_amount = get_params.get('amount')
         return_status = get_params.get('status')
 
         tx_id_ifthen = get_params.get('txid')
+        if tx_id_ifthen == '[TRANSACTIONID]':  # placeholder not filled in by the gateway
+            tx_id_ifthen = None
 
-        tx = request.env['payment.transaction'].sudo().search([
-            ('reference', '=', odoo_tx_reference),
-            ('amount', '=', odoo_amount),
-            ('provider_code', '=', 'ifthenpay')
-        ], limit=1)
+        tx = request.env['payment.transaction']._ifthenpay_get_tx_by_reference(odoo_tx_reference, odoo_amount or 0.0)
 
         if not tx:
             _logger.error("ifthenpay_iframe_callback: Transacao Odoo ou token invalido para referencia %s.", odoo_tx_reference)
-            return request.render(
-                'payment_ifthenpay_oficial.ifthenpay_iframe_error_template', 
-                {'message': _('Invalid or expired transaction.'), 'title': _('An error occurred while processing the payment:')}
-            )
+            return self._ifthenpay_iframe_result('failed', _('Invalid or expired transaction.'))
 
         provider = tx.provider_id
         if not provider:
             _logger.error("ifthenpay_iframe_callback: Provedor de pagamento nao encontrado para a transacao %s.", tx.reference)
-            return request.render(
-                'payment_ifthenpay_oficial.ifthenpay_iframe_error_template', 
-                {'message': _('Payment provider configuration error.'), 'title': _('An error occurred while processing the payment:')}
-            )
+            return self._ifthenpay_iframe_result('failed', _('Payment provider configuration error.'))
         
         # in the gateway, when clicking on complete, it falls into this route, 
         # so the status goes to pending because it was not necessarily paid when clicking on 'complete', so it waits for the callback route
         if return_status == 'cancel':
             tx._set_pending(state_message=_('Payment initiated with ifthenpay, awaiting confirmation.'))
-            return request.render('payment_ifthenpay_oficial.ifthenpay_iframe_post_message_template', {
-                'payment_status': 'pending',
-                'message': _('Your payment is being processed and awaiting confirmation. Please wait.')
-            })
+            return self._ifthenpay_iframe_result(
+                'pending', _('Your payment is being processed and awaiting confirmation. Please wait.')
+            )
 
         if return_status == 'error':
             _logger.warning("ifthenpay: Redirecionamento de ERRO recebido para transacao %s.", tx.reference)
             if tx.state not in ('cancel', 'error'): # Evita sobrescrever um estado final de 'cancel' ou 'error'
                 tx._set_error(state_message=_('An error occurred while trying to process the payment with ifthenpay. Please try again.'))
-            return request.render(
-                'payment_ifthenpay_oficial.ifthenpay_iframe_post_message_template', 
-                {'message': _('Payment provider configuration error.'), 'title': _('An error occurred while processing the payment:')}
-            )
+            return self._ifthenpay_iframe_result('failed', tx.state_message)
 
+        # the gateway status is looked up in the background so that the worker is released right away
         if tx.state == 'draft':
+            tx._set_pending(state_message=_('Payment initiated with ifthenpay, awaiting confirmation.'))
             if tx_id_ifthen:
-                try:
-                    return_tx = tx._ifthenpay_poll_status(tx_id_ifthen)
-
-                    if return_tx and return_tx.get("PaymentMethod") in ("CCARD", "APPLE", "GOOGLE"):
-                        get_params['apk'] = provider.ifthenpay_api_key
-                        request.env['payment.transaction'].sudo()._handle_notification_data('ifthenpay', get_params)
-                        return request.render('payment_ifthenpay_oficial.ifthenpay_iframe_post_message_template', {
-                            'payment_status': 'success',
-                            'message': 'Pagamento realizado com sucesso!',
-                        })
-                    else:
-                        tx._set_pending(state_message=_('Payment initiated with ifthenpay, awaiting confirmation.'))
-
-                except requests.exceptions.RequestException as e:
-                    _logger.error("Erro inesperado ao verificar o status da transacao %s: %s", tx_id_ifthen, e)
-                    tx._set_error(state_message=f'Ocorreu um erro inesperado: {e}')
-                    return request.render('payment_ifthenpay_oficial.ifthenpay_iframe_post_message_template', {
-                        'payment_status': 'failed',
-                        'message': _("There was an error in the payment."),
-                    })
-                except Exception as e:
-                    _logger.error("Erro inesperado ao verificar o status da transacao %s: %s", tx_id_ifthen, e)
-                    tx._set_error(state_message=f'Ocorreu um erro inesperado: {e}')
-                    return request.render('payment_ifthenpay_oficial.ifthenpay_iframe_post_message_template', {
-                        'payment_status': 'failed',
-                        'message': _("There was an error in the payment."),
-                    })
-            else:
-                tx._set_pending(state_message=_('Payment initiated with ifthenpay, awaiting confirmation.'))
+                tx._ifthenpay_schedule_status_poll(tx_id_ifthen)
 
         payment_status = 'pending'
         message = 'Your payment is being processed and awaiting confirmation. Please wait.'
@@ -218,7 +340,16 @@ class IfthenpayController(http.Controller):
             payment_status = 'failed'
             message = tx.state_message or 'O pagamento falhou ou foi cancelado.'
 
-        return request.render('payment_ifthenpay_oficial.ifthenpay_iframe_post_message_template', {
-            'payment_status': payment_status,
-            'message': message,
-        })
\ No newline at end of file
+        return self._ifthenpay_iframe_result(payment_status, message)
+
+    def _ifthenpay_iframe_result(self, payment_status, message):
+        """ Return the status of a payment to the return page of the gateway.
+
+        :param str payment_status: The status of the payment: `success`, `pending` or `failed`.
+        :param str message: The message to display to the customer.
+        :return: The JSON response, never cached.
+        :rtype: odoo.http.Response
+        """
+        return request.make_json_response(
+            {'status': payment_status, 'message': message}, headers=[('Cache-Control', 'no-store')],
+        )
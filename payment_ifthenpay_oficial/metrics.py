@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+from collections import defaultdict
+
+# Histograms: kind -> (Prometheus name, help, label names, upper bounds of the buckets).
+HISTOGRAMS = {
+    'api': (
+        'ifthenpay_api_request_duration_seconds',
+        "Duration of the calls to the ifthenpay API, by endpoint and result.",
+        ('endpoint', 'result'),
+        (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+    ),
+    'route': (
+        'ifthenpay_route_duration_seconds',
+        "Duration of the requests to the ifthenpay routes, by route and result.",
+        ('route', 'result'),
+        (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    ),
+    'route_queries': (
+        'ifthenpay_route_sql_queries',
+        "SQL queries run by the requests to the ifthenpay routes, by route and result.",
+        ('route', 'result'),
+        (1, 2, 5, 10, 20, 50, 100, 200, 500),
+    ),
+    'callback': (
+        'ifthenpay_callback_duration_seconds',
+        "Time spent on the callbacks of ifthenpay, by step (queue, process) and result.",
+        ('step', 'result'),
+        (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300, 900),
+    ),
+}
+
+# Counters of the events that have no duration: kind -> (Prometheus name, help, label names). They
+# are kept out of the histograms so that the quantiles only account for actual calls.
+COUNTERS = {
+    'api_error': (
+        'ifthenpay_api_errors_total',
+        "Calls to the ifthenpay API refused by the circuit breaker or answered with an invalid body, "
+        "by endpoint and error.",
+        ('endpoint', 'error'),
+    ),
+}
+
+# Label of the bucket that counts all the observations, and the only one holding their sum.
+INF = '+Inf'
+
+# Seconds between two flushes of the observations of a process to the database. Benchmarks set
+# the environment variable to 0 so that every worker's observations are visible right away.
+FLUSH_INTERVAL = float(os.environ.get('IFTHENPAY_METRICS_FLUSH_INTERVAL', 30))
+
+_lock = threading.Lock()
+_pending = defaultdict(lambda: [0, 0.0])  # (kind, name, result, le) -> [count, sum]
+_last_flush = time.monotonic()
+
+
+def observe(kind, name, result, value):
+    """ Record an observation in the memory of the current process.
+
+    :param str kind: The histogram, as a key of `HISTOGRAMS`.
+    :param str name: The value of the first label, e.g. the endpoint.
+    :param str result: The value of the second label, e.g. the HTTP status.
+    :param float value: The observed value.
+    :return: None
+    """
+    result = str(result)
+    with _lock:
+        for le in HISTOGRAMS[kind][3]:
+            if value <= le:
+                _pending[kind, name, result, str(le)][0] += 1
+                break
+        total = _pending[kind, name, result, INF]
+        total[0] += 1
+        total[1] += value
+
+
+def count(kind, name, result):
+    """ Count an event in the memory of the current process.
+
+    :param str kind: The counter, as a key of `COUNTERS`.
+    :param str name: The value of the first label, e.g. the endpoint.
+    :param str result: The value of the second label, e.g. the error.
+    :return: None
+    """
+    with _lock:
+        _pending[kind, name, str(result), INF][0] += 1
+
+
+def pop_pending(force=False):
+    """ Return and forget the observations recorded since the last flush, if the flush is due.
+
+    :param bool force: Whether to flush even though `FLUSH_INTERVAL` has not elapsed.
+    :return: The observations, as `(kind, name, result, le, count, sum)` tuples.
+    :rtype: list
+    """
+    global _last_flush
+    with _lock:
+        if not _pending or (not force and time.monotonic() - _last_flush < FLUSH_INTERVAL):
+            return []
+        rows = [key + tuple(value) for key, value in _pending.items()]
+        _pending.clear()
+        _last_flush = time.monotonic()
+    return rows
+
+
+def render(rows, gauges=()):
+    """ Render metrics in the Prometheus text format.
+
+    :param list rows: The stored observations, as `(kind, name, result, le, count, sum)` tuples,
+                      with non-cumulative bucket counts.
+    :param list gauges: The gauges, as `(name, help, labels, value)` tuples.
+    :return: The exposition text.
+    :rtype: str
+    """
+    series = defaultdict(lambda: {'buckets': defaultdict(int), 'count': 0, 'sum': 0.0})
+    for kind, name, result, le, count, total in rows:
+        if kind not in HISTOGRAMS and kind not in COUNTERS:
+            continue
+        serie = series[kind, name, result]
+        if le == INF:
+            serie['count'] += count
+            serie['sum'] += total
+        else:
+            serie['buckets'][float(le)] += count
+
+    lines = []
+    for kind, (metric, help_text, label_names, bounds) in HISTOGRAMS.items():
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} histogram']
+        for (serie_kind, name, result), serie in sorted(series.items()):
+            if serie_kind != kind:
+                continue
+            labels = f'{label_names[0]}="{_escape(name)}",{label_names[1]}="{_escape(result)}"'
+            cumulative = 0
+            for le in bounds:
+                cumulative += serie['buckets'][float(le)]
+                lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{{labels},le="{INF}"}} {serie["count"]}')
+            lines.append(f'{metric}_sum{{{labels}}} {serie["sum"]}')
+            lines.append(f'{metric}_count{{{labels}}} {serie["count"]}')
+
+    for kind, (metric, help_text, label_names) in COUNTERS.items():
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+        for (serie_kind, name, result), serie in sorted(series.items()):
+            if serie_kind == kind:
+                labels = f'{label_names[0]}="{_escape(name)}",{label_names[1]}="{_escape(result)}"'
+                lines.append(f'{metric}{{{labels}}} {serie["count"]}')
+
+    for metric, help_text, labels, value in gauges:
+        if f'# TYPE {metric} gauge' not in lines:
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} gauge']
+        label_text = ','.join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+        lines.append(f'{metric}{{{label_text}}} {value}' if label_text else f'{metric} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
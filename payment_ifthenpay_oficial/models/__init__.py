@@ -1,3 +1,9 @@
 # -*- coding: utf-8 -*-
 from . import payment_provider
 from . import payment_transaction
+from . import payment_ifthenpay_notification
+from . import payment_ifthenpay_circuit
+from . import payment_ifthenpay_metric
+from . import payment_ifthenpay_link_batch
+from . import payment_ifthenpay_rate_limit
+from . import payment_ifthenpay_settlement
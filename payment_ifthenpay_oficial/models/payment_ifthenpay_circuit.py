@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import logging
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from odoo.addons.payment_ifthenpay_oficial.utils import shared_state_cursor
+
+_logger = logging.getLogger(__name__)
+
+
+class PaymentIfthenpayCircuit(models.Model):
+    _name = 'payment.ifthenpay.circuit'
+    _description = "ifthenpay API Circuit Breaker"
+    _rec_name = 'endpoint'
+
+    endpoint = fields.Char(required=True, readonly=True)
+    state = fields.Selection(
+        [('closed', "Closed"), ('open', "Open"), ('half_open', "Probing")],
+        default='closed', required=True, readonly=True,
+    )
+    failure_count = fields.Integer(string="Consecutive Failures", readonly=True)
+    opened_date = fields.Datetime(readonly=True)
+
+    _sql_constraints = [
+        ('endpoint_uniq', 'unique(endpoint)', "There can only be one circuit per endpoint."),
+    ]
+
+    @api.model
+    def _get_settings(self):
+        ICP = self.env['ir.config_parameter'].sudo()
+        threshold = int(ICP.get_param('payment_ifthenpay_oficial.circuit_failure_threshold', 5))
+        cooldown = int(ICP.get_param('payment_ifthenpay_oficial.circuit_cooldown', 60))
+        return threshold, cooldown
+
+    @api.model
+    def _get_state(self, endpoint):
+        self.env.cr.execute(
+            "SELECT state, failure_count, opened_date FROM payment_ifthenpay_circuit WHERE endpoint = %s",
+            [endpoint],
+        )
+        return self.env.cr.fetchone() or ('closed', 0, None)
+
+    @api.model
+    def _is_open(self, endpoint):
+        """ Return whether calls to the endpoint are currently refused.
+
+        :param str endpoint: The endpoint, as a key of `const.API_ENDPOINTS`.
+        :return: Whether the circuit is open and its cool-down has not elapsed yet.
+        :rtype: bool
+        """
+        state, _failure_count, opened_date = self._get_state(endpoint)
+        if state == 'closed' or not opened_date:
+            return False
+        _threshold, cooldown = self._get_settings()
+        return fields.Datetime.now() < opened_date + timedelta(seconds=cooldown)
+
+    @api.model
+    def _allow(self, endpoint):
+        """ Return whether a call to the endpoint may be sent.
+
+        Once the cool-down of an open circuit has elapsed, a single caller is let through as a probe
+        and the circuit is half-open until the result of the probe is recorded.
+
+        :param str endpoint: The endpoint, as a key of `const.API_ENDPOINTS`.
+        :return: Whether the call may be sent.
+        :rtype: bool
+        """
+        state, _failure_count, _opened_date = self._get_state(endpoint)
+        if state == 'closed':
+            return True
+        if self._is_open(endpoint):
+            return False
+        _threshold, cooldown = self._get_settings()
+        now = fields.Datetime.now()
+        with shared_state_cursor(self.env) as cr:
+            cr.execute("""
+                UPDATE payment_ifthenpay_circuit
+                   SET state = 'half_open', opened_date = %s
+                 WHERE endpoint = %s AND state != 'closed' AND opened_date < %s
+             RETURNING id
+            """, [now, endpoint, now - timedelta(seconds=cooldown)])
+            is_probe = bool(cr.fetchone())
+        if is_probe:
+            _logger.info("ifthenpay: probing the %s endpoint.", endpoint)
+        return is_probe
+
+    @api.model
+    def _record(self, endpoint, success):
+        """ Record the outcome of a call to the endpoint and open or close the circuit accordingly.
+
+        :param str endpoint: The endpoint, as a key of `const.API_ENDPOINTS`.
+        :param bool success: Whether the endpoint answered.
+        :return: None
+        """
+        state, failure_count, _opened_date = self._get_state(endpoint)
+        if success:
+            if state == 'closed' and not failure_count:
+                return
+            with shared_state_cursor(self.env) as cr:
+                cr.execute("""
+                    UPDATE payment_ifthenpay_circuit
+                       SET state = 'closed', failure_count = 0, opened_date = NULL
+                     WHERE endpoint = %s
+                """, [endpoint])
+            if state != 'closed':
+                _logger.info("ifthenpay: the %s endpoint answers again, circuit closed.", endpoint)
+            return
+
+        threshold, _cooldown = self._get_settings()
+        with shared_state_cursor(self.env) as cr:
+            cr.execute("""
+                INSERT INTO payment_ifthenpay_circuit (endpoint, state, failure_count, opened_date)
+                     VALUES (%(endpoint)s, CASE WHEN %(threshold)s <= 1 THEN 'open' ELSE 'closed' END, 1,
+                             CASE WHEN %(threshold)s <= 1 THEN %(now)s END)
+                ON CONFLICT (endpoint) DO UPDATE
+                        SET failure_count = payment_ifthenpay_circuit.failure_count + 1,
+                            state = CASE
+                                WHEN payment_ifthenpay_circuit.state = 'half_open'
+                                  OR payment_ifthenpay_circuit.failure_count + 1 >= %(threshold)s THEN 'open'
+                                ELSE payment_ifthenpay_circuit.state
+                            END,
+                            opened_date = CASE
+                                WHEN payment_ifthenpay_circuit.state = 'half_open'
+                                  OR (payment_ifthenpay_circuit.state = 'closed'
+                                      AND payment_ifthenpay_circuit.failure_count + 1 >= %(threshold)s) THEN %(now)s
+                                ELSE payment_ifthenpay_circuit.opened_date
+                            END
+                  RETURNING state
+            """, {'endpoint': endpoint, 'threshold': threshold, 'now': fields.Datetime.now()})
+            new_state = cr.fetchone()[0]
+        if new_state == 'open' and state != 'open':
+            _logger.warning("ifthenpay: the %s endpoint keeps failing, circuit opened.", endpoint)
+
+    def action_reset(self):
+        self.write({'state': 'closed', 'failure_count': 0, 'opened_date': False})
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+import psycopg2
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+from odoo.fields import Command
+
+from odoo.addons.payment_ifthenpay_oficial import client
+
+_logger = logging.getLogger(__name__)
+
+# The documents payment links can be generated for, and the field linking them to the transactions.
+DOCUMENT_TRANSACTION_FIELDS = {
+    'account.move': 'invoice_ids',
+    'sale.order': 'sale_order_ids',
+}
+
+
+class PaymentIfthenpayLinkBatch(models.Model):
+    _name = 'payment.ifthenpay.link.batch'
+    _description = "ifthenpay Payment Link Batch"
+    _order = 'id desc'
+
+    name = fields.Char(required=True, default=lambda self: _("Payment links of %s", fields.Date.context_today(self)))
+    provider_id = fields.Many2one(
+        'payment.provider', required=True, ondelete='cascade', domain=[('code', '=', 'ifthenpay')],
+    )
+    state = fields.Selection(
+        [('draft', "Draft"), ('running', "Running"), ('done', "Done"), ('cancel', "Canceled")],
+        default='draft', required=True, readonly=True, index=True,
+    )
+    line_ids = fields.One2many('payment.ifthenpay.link.batch.line', 'batch_id', string="Documents", readonly=True)
+    rate_limit = fields.Float(
+        string="Requests per second",
+        help="The maximum number of payment links requested from ifthenpay per second.",
+        default=lambda self: float(self.env['ir.config_parameter'].sudo().get_param(
+            'payment_ifthenpay_oficial.link_rate_limit', 5
+        )),
+    )
+    max_workers = fields.Integer(
+        string="Concurrent requests",
+        default=lambda self: int(self.env['ir.config_parameter'].sudo().get_param(
+            'payment_ifthenpay_oficial.link_workers', 4
+        )),
+    )
+    line_count = fields.Integer(string="Number of Documents", compute='_compute_progress')
+    done_count = fields.Integer(string="Generated", compute='_compute_progress')
+    error_count = fields.Integer(string="Failed", compute='_compute_progress')
+    progress = fields.Float(compute='_compute_progress')
+
+    def _compute_progress(self):
+        counts = {
+            (batch, state): count for batch, state, count in self.env['payment.ifthenpay.link.batch.line']._read_group(
+                [('batch_id', 'in', self._origin.ids)], ['batch_id', 'state'], ['__count'],
+            )
+        }
+        for batch in self:
+            done = counts.get((batch._origin, 'done'), 0)
+            error = counts.get((batch._origin, 'error'), 0)
+            total = done + error + counts.get((batch._origin, 'pending'), 0)
+            batch.line_count = total
+            batch.done_count = done
+            batch.error_count = error
+            batch.progress = total and (done + error) * 100 / total
+
+    @api.model
+    def _action_create_from_records(self, records):
+        """ Create a batch of payment links for invoices or sale orders and open it.
+
+        Only the posted customer invoices and the unconfirmed or confirmed sale orders with an amount
+        left to pay are added.
+
+        :param recordset records: The `account.move` or `sale.order` records.
+        :return: The action opening the batch.
+        :rtype: dict
+        :raise UserError: If none of the records needs a payment link.
+        :raise UserError: If the records belong to several companies.
+        """
+        if records._name == 'account.move':
+            records = records.filtered(lambda move: (
+                move.state == 'posted'
+                and move.move_type in ('out_invoice', 'out_receipt')
+                and move.currency_id.compare_amounts(move.amount_residual, 0) > 0
+            ))
+            amounts = {move: move.amount_residual for move in records}
+        elif records._name == 'sale.order':
+            records = records.filtered(lambda order: (
+                order.state in ('draft', 'sent', 'sale')
+                and order.currency_id.compare_amounts(order.amount_total - order.amount_paid, 0) > 0
+            ))
+            amounts = {order: order.amount_total - order.amount_paid for order in records}
+        else:
+            raise UserError(_("Payment links can only be generated for invoices and sale orders."))
+        if not records:
+            raise UserError(_("None of the selected documents has an amount left to pay."))
+        if len(records.company_id) > 1:
+            raise UserError(_(
+                "The selected documents belong to several companies. Generate the payment links of each "
+                "company separately."
+            ))
+
+        provider = self.env['payment.provider'].search([
+            ('code', '=', 'ifthenpay'),
+            ('state', '!=', 'disabled'),
+            ('company_id', '=', records.company_id.id),
+        ], limit=1)
+        if not provider:
+            raise UserError(_("No ifthenpay payment provider is enabled for this company."))
+
+        batch = self.create({
+            'provider_id': provider.id,
+            'line_ids': [Command.create({
+                'res_model': record._name,
+                'res_id': record.id,
+                'document_name': record.display_name,
+                'partner_id': record.partner_id.id,
+                'amount': amounts[record],
+                'currency_id': record.currency_id.id,
+            }) for record in records],
+        })
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': batch.id,
+            'view_mode': 'form',
+        }
+
+    def action_start(self):
+        self.filtered(lambda batch: batch.state in ('draft', 'done')).state = 'running'
+        self.env.ref('payment_ifthenpay_oficial.cron_ifthenpay_process_link_batches')._trigger()
+
+    def action_retry_failed(self):
+        self.line_ids.filtered(lambda line: line.state == 'error').write({'state': 'pending', 'error': False})
+        self.action_start()
+
+    def action_cancel(self):
+        self.filtered(lambda batch: batch.state in ('draft', 'running')).state = 'cancel'
+
+    @api.model
+    def _cron_process(self):
+        """ Generate the payment links of the running batches until the time budget is spent.
+
+        Each chunk of lines is committed on its own so that an interrupted run resumes where it
+        stopped; the run schedules itself again when it runs out of time.
+
+        :return: None
+        """
+        time_budget = int(self.env['ir.config_parameter'].sudo().get_param(
+            'payment_ifthenpay_oficial.link_time_budget', 600
+        ))
+        deadline = time.monotonic() + time_budget
+        for batch in self.search([('state', '=', 'running')], order='id'):
+            try:
+                batch._process(deadline)
+            except psycopg2.OperationalError as e:
+                _logger.info("ifthenpay: payment link batch %s postponed: %s", batch.id, e)
+                self.env.cr.rollback()
+            except Exception as e:
+                # failing the batch keeps it from being retried first on every run, ahead of the others
+                self.env.cr.rollback()
+                batch.line_ids.filtered(lambda line: line.state == 'pending').write({'state': 'error', 'error': str(e)})
+                batch.state = 'done'
+                _logger.exception("ifthenpay: payment link batch %s failed: %s", batch.id, e)
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
+            if time.monotonic() > deadline:
+                self.env.ref('payment_ifthenpay_oficial.cron_ifthenpay_process_link_batches')._trigger()
+                break
+
+    def _process(self, deadline):
+        """ Generate the payment links of the pending lines of the batch, chunk by chunk.
+
+        Note: `self.ensure_one()`
+
+        :param float deadline: The `time.monotonic()` value after which no new chunk is started.
+        :return: None
+        """
+        self.ensure_one()
+        chunk_size = int(self.env['ir.config_parameter'].sudo().get_param(
+            'payment_ifthenpay_oficial.link_batch_size', 100
+        ))
+        Line = self.env['payment.ifthenpay.link.batch.line']
+        while time.monotonic() < deadline:
+            lines = Line.search([('batch_id', '=', self.id), ('state', '=', 'pending')], limit=chunk_size)
+            if not lines:
+                self.state = 'done'
+                _logger.info("ifthenpay: payment link batch %s done.", self.id)
+                break
+            lines._create_transactions()
+            completed = lines._request_payment_links(self.max_workers, self.rate_limit)
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
+            if not completed:
+                _logger.info("ifthenpay: payment link batch %s paused, the API is unavailable.", self.id)
+                break
+
+
+class PaymentIfthenpayLinkBatchLine(models.Model):
+    _name = 'payment.ifthenpay.link.batch.line'
+    _description = "ifthenpay Payment Link"
+    _order = 'id'
+    _rec_name = 'document_name'
+
+    batch_id = fields.Many2one('payment.ifthenpay.link.batch', required=True, ondelete='cascade', index=True)
+    res_model = fields.Char(string="Document Model", required=True, readonly=True)
+    res_id = fields.Many2oneReference(string="Document", model_field='res_model', required=True, readonly=True)
+    document_name = fields.Char(string="Document", readonly=True)
+    partner_id = fields.Many2one('res.partner', readonly=True)
+    amount = fields.Monetary(readonly=True)
+    currency_id = fields.Many2one('res.currency', readonly=True)
+    transaction_id = fields.Many2one('payment.transaction', readonly=True)
+    payment_url = fields.Char(string="Payment Link", readonly=True)
+    state = fields.Selection(
+        [('pending', "Pending"), ('done', "Generated"), ('error', "Failed")],
+        default='pending', required=True, readonly=True, index=True,
+    )
+    error = fields.Text(readonly=True)
+
+    def _create_transactions(self):
+        """ Create the transactions of the lines that have none yet, with one `create` per document model.
+
+        :return: None
+        """
+        Transaction = self.env['payment.transaction'].sudo()
+        for res_model, transaction_field in DOCUMENT_TRANSACTION_FIELDS.items():
+            lines = self.filtered(lambda line: not line.transaction_id and line.res_model == res_model)
+            if not lines:
+                continue
+            vals_list = []
+            for line in lines:
+                provider = line.batch_id.provider_id
+                documents = [Command.set([line.res_id])]
+                vals_list.append({
+                    'provider_id': provider.id,
+                    'payment_method_id': provider.payment_method_ids.filtered(
+                        lambda method: method.code == 'ifthenpay'
+                    )[:1].id or self.env.ref('payment_ifthenpay_oficial.payment_method_ifthenpay_provider').id,
+                    'reference': Transaction._compute_reference(provider.code, **{transaction_field: documents}),
+                    'amount': line.amount,
+                    'currency_id': line.currency_id.id,
+                    'partner_id': line.partner_id.id,
+                    'operation': 'online_redirect',
+                    transaction_field: documents,
+                })
+            for line, tx in zip(lines, Transaction.create(vals_list)):
+                line.transaction_id = tx
+
+    def _request_payment_links(self, max_workers, rate_limit):
+        """ Request the Pinpay payment links of the lines concurrently, under a rate limit.
+
+        Lines whose transaction already has a valid link reuse it. The requests are sent in slices
+        of `max_workers` and each slice lasts at least as long as `rate_limit` allows.
+
+        :param int max_workers: The maximum number of concurrent requests.
+        :param float rate_limit: The maximum number of requests per second, 0 for no limit.
+        :return: Whether all the lines were handled, i.e. the API did not become unavailable.
+        :rtype: bool
+        """
+        for line in self:
+            tx = line.transaction_id
+            if tx._ifthenpay_is_pinpay_url_valid():
+                line.write({'state': 'done', 'payment_url': tx.ifthenpay_pinpay_url, 'error': False})
+            elif tx.state not in ('draft', 'pending'):
+                line.write({'state': 'error', 'error': _("The transaction %s is no longer open.", tx.reference)})
+
+        lines = self.filtered(lambda line: line.state == 'pending')
+        Circuit = self.env['payment.ifthenpay.circuit'].sudo()
+        max_workers = max(max_workers, 1)
+        completed = True
+        for index in range(0, len(lines), max_workers):
+            if not Circuit._allow('pinpay'):
+                completed = False
+                break
+            started = time.monotonic()
+
+            prepared = {}
+            for line in lines[index:index + max_workers]:
+                try:
+                    prepared[line] = line.transaction_id.provider_id._ifthenpay_prepare_pinpay_request(
+                        line.transaction_id
+                    )
+                except UserError as e:
+                    line.write({'state': 'error', 'error': e.args[0]})
+            results = client.request_many(list(prepared.values()), max_workers)
+            if results:
+                Circuit._record('pinpay', success=not all(client.is_failure(result) for result in results))
+
+            for line, result in zip(prepared, results):
+                tx = line.transaction_id
+                try:
+                    if isinstance(result, Exception):
+                        raise UserError(_("Unable to connect to ifthenpay: %s", result))
+                    payment_url = tx.provider_id._ifthenpay_parse_pinpay_response(result)['payment_url']
+                except UserError as e:
+                    line.write({'state': 'error', 'error': e.args[0]})
+                    continue
+                tx._ifthenpay_set_pinpay_url(payment_url)
+                line.write({'state': 'done', 'payment_url': payment_url, 'error': False})
+
+            if rate_limit > 0:
+                remaining = len(prepared) / rate_limit - (time.monotonic() - started)
+                if remaining > 0:
+                    time.sleep(remaining)
+        self.env['payment.ifthenpay.metric']._flush()
+        return completed
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models, tools
+
+from odoo.addons.payment_ifthenpay_oficial import metrics
+from odoo.addons.payment_ifthenpay_oficial.utils import shared_state_cursor
+
+
+class PaymentIfthenpayMetric(models.Model):
+    _name = 'payment.ifthenpay.metric'
+    _description = "ifthenpay Metric"
+    _order = 'kind, name, result'
+
+    kind = fields.Char(required=True, readonly=True)
+    name = fields.Char(required=True, readonly=True)
+    result = fields.Char(required=True, readonly=True)
+    le = fields.Char(string="Bucket", required=True, readonly=True)
+    count = fields.Integer(readonly=True)
+    total = fields.Float(readonly=True)
+
+    _sql_constraints = [
+        ('bucket_uniq', 'unique(kind, name, result, le)', "There can only be one row per bucket."),
+    ]
+
+    @api.model
+    def _flush(self, force=False):
+        """ Add the observations recorded by the current process to the shared counters.
+
+        :param bool force: Whether to flush even though the flush interval has not elapsed.
+        :return: None
+        """
+        rows = metrics.pop_pending(force=force)
+        if not rows:
+            return
+        with shared_state_cursor(self.env) as cr:
+            for row in rows:
+                cr.execute("""
+                    INSERT INTO payment_ifthenpay_metric (kind, name, result, le, count, total)
+                         VALUES (%s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (kind, name, result, le) DO UPDATE
+                            SET count = payment_ifthenpay_metric.count + EXCLUDED.count,
+                                total = payment_ifthenpay_metric.total + EXCLUDED.total
+                """, row)
+
+    @api.model
+    def _render_prometheus(self):
+        """ Return all the metrics of the module in the Prometheus text format.
+
+        :return: The exposition text.
+        :rtype: str
+        """
+        self._flush(force=True)
+        self.env.cr.execute("SELECT kind, name, result, le, count, total FROM payment_ifthenpay_metric")
+        rows = self.env.cr.fetchall()
+
+        gauges = []
+        backlog = self.env['payment.ifthenpay.notification'].sudo()._read_group(
+            [('state', '=', 'pending')], ['provider_id'], ['__count'],
+        )
+        gauges.append((
+            'ifthenpay_callback_queue_depth', "Callbacks waiting to be processed.", {}, sum(count for _p, count in backlog),
+        ))
+        for circuit in self.env['payment.ifthenpay.circuit'].sudo().search([]):
+            gauges.append((
+                'ifthenpay_circuit_open', "Whether the circuit breaker of the endpoint refuses calls.",
+                {'endpoint': circuit.endpoint}, int(circuit.state != 'closed'),
+            ))
+        return metrics.render(rows, gauges)
+
+
+class PaymentIfthenpayMetricReport(models.Model):
+    _name = 'payment.ifthenpay.metric.report'
+    _description = "ifthenpay Metrics Summary"
+    _auto = False
+    _order = 'kind, name, result'
+
+    kind = fields.Char(readonly=True)
+    name = fields.Char(readonly=True)
+    result = fields.Char(readonly=True)
+    count = fields.Integer(readonly=True)
+    total = fields.Float(string="Total Value", readonly=True)
+    average = fields.Float(readonly=True, aggregator='avg')
+
+    def init(self):
+        tools.drop_view_if_exists(self.env.cr, self._table)
+        self.env.cr.execute(f"""
+            CREATE OR REPLACE VIEW {self._table} AS (
+                SELECT id, kind, name, result, count, total,
+                       CASE WHEN count > 0 THEN total / count ELSE 0 END AS average
+                  FROM payment_ifthenpay_metric
+                 WHERE le = %s
+            )
+        """, [metrics.INF])
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from datetime import timedelta
+
+import psycopg2
+
+from odoo import api, fields, models
+
+from odoo.addons.payment_ifthenpay_oficial import metrics
+
+_logger = logging.getLogger(__name__)
+
+
+class PaymentIfthenpayNotification(models.Model):
+    _name = 'payment.ifthenpay.notification'
+    _description = "ifthenpay Callback"
+    _order = 'id'
+    _rec_name = 'reference'
+
+    provider_id = fields.Many2one('payment.provider', required=True, ondelete='cascade', readonly=True)
+    reference = fields.Char(readonly=True)
+    data = fields.Json(string="Callback Data", readonly=True)
+    state = fields.Selection(
+        [('pending', "Pending"), ('done', "Processed"), ('error', "Failed")],
+        default='pending', required=True, readonly=True, index=True,
+    )
+    error = fields.Text(readonly=True)
+    processed_date = fields.Datetime(readonly=True)
+
+    @api.model
+    def _enqueue(self, provider, notification_data):
+        """ Store a callback of ifthenpay for `_cron_process` to handle it.
+
+        The anti-phishing key is checked by the caller and is not stored: it is restored from the
+        provider when the callback is processed.
+
+        :param recordset provider: The `payment.provider` the callback is addressed to.
+        :param dict notification_data: The notification data sent by ifthenpay.
+        :return: The stored callback.
+        :rtype: recordset of `payment.ifthenpay.notification`
+        """
+        notification = self.create({
+            'provider_id': provider.id,
+            'reference': notification_data.get('reference'),
+            'data': {k: v for k, v in notification_data.items() if k != 'apk'},
+        })
+        self.env.ref('payment_ifthenpay_oficial.cron_ifthenpay_process_notifications')._trigger()
+        return notification
+
+    @api.model
+    def _get_batch_size(self):
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'payment_ifthenpay_oficial.notification_batch_size', 200
+        ))
+
+    @api.model
+    def _cron_process(self):
+        """ Process the pending callbacks in chunks, committing after each chunk.
+
+        Each callback is tried at most once per run: the postponed ones are left for a run scheduled
+        a minute later, so that a lasting lock or timeout does not keep the cron busy.
+
+        :return: None
+        """
+        batch_size = self._get_batch_size()
+        last_id = 0
+        postponed = False
+        while True:
+            notifications = self.search([('state', '=', 'pending'), ('id', '>', last_id)], limit=batch_size)
+            if not notifications:
+                break
+            last_id = notifications[-1].id
+            postponed |= not notifications._process()
+            if self.env.registry.in_test_mode():
+                break
+            self.env.cr.commit()
+        if postponed:
+            self.env.ref('payment_ifthenpay_oficial.cron_ifthenpay_process_notifications')._trigger(
+                at=fields.Datetime.now() + timedelta(minutes=1)
+            )
+
+    def _process(self):
+        """ Handle the notification data of the callbacks and mark them as processed or failed.
+
+        :return: Whether all the callbacks were handled, i.e. none was postponed.
+        :rtype: bool
+        """
+        processed = self.browse()
+        completed = True
+        for notification in self:
+            started = time.perf_counter()
+            try:
+                with self.env.cr.savepoint():
+                    self.env['payment.transaction'].sudo()._handle_notification_data(
+                        'ifthenpay', dict(notification.data, apk=notification.provider_id.ifthenpay_api_key)
+                    )
+                processed |= notification
+                result = 'done'
+            except psycopg2.OperationalError as e:
+                # the transaction is being updated concurrently: keep the callback for the next run
+                _logger.info("ifthenpay: callback %s postponed: %s", notification.reference, e)
+                result = 'postponed'
+                completed = False
+            except Exception as e:
+                _logger.exception("ifthenpay: callback %s could not be processed: %s", notification.reference, e)
+                notification.write({
+                    'state': 'error',
+                    'error': str(e),
+                    'processed_date': fields.Datetime.now(),
+                })
+                result = 'error'
+            metrics.observe('callback', 'process', result, time.perf_counter() - started)
+            if result != 'postponed':
+                metrics.observe(
+                    'callback', 'queue', result, (fields.Datetime.now() - notification.create_date).total_seconds()
+                )
+        processed.write({'state': 'done', 'processed_date': fields.Datetime.now()})
+        self.env['payment.ifthenpay.metric']._flush()
+        return completed
+
+    def action_retry(self):
+        self.filtered(lambda n: n.state == 'error').write({'state': 'pending', 'error': False})
+        self.env.ref('payment_ifthenpay_oficial.cron_ifthenpay_process_notifications')._trigger()
+
+    @api.autovacuum
+    def _gc_processed(self):
+        self.search([
+            ('state', '=', 'done'),
+            ('processed_date', '<', fields.Datetime.now() - timedelta(days=30)),
+        ]).unlink()
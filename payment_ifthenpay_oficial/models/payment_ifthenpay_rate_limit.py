@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import math
+
+from odoo import api, models
+
+from odoo.addons.payment_ifthenpay_oficial.utils import shared_state_cursor
+
+# The token count of a bucket once refilled: the stored tokens plus those earned since the last
+# request, capped to the capacity of the bucket.
+REFILLED_TOKENS = """
+    LEAST(%(capacity)s, bucket.tokens + EXTRACT(EPOCH FROM clock_timestamp() - bucket.updated_at) * %(rate)s)
+"""
+
+
+class PaymentIfthenpayRateLimit(models.AbstractModel):
+    """ Token buckets limiting the requests of the clients to the public routes.
+
+    The buckets live in an UNLOGGED table shared by all the workers: they are written on every
+    request, do not need to survive a crash and must not bloat the WAL.
+    """
+    _name = 'payment.ifthenpay.rate.limit'
+    _description = "ifthenpay Rate Limiter"
+
+    def init(self):
+        self.env.cr.execute("""
+            CREATE UNLOGGED TABLE IF NOT EXISTS payment_ifthenpay_rate_limit (
+                key varchar PRIMARY KEY,
+                tokens double precision NOT NULL,
+                allowed boolean NOT NULL,
+                updated_at timestamptz NOT NULL
+            )
+        """)
+
+    @api.model
+    def _consume(self, buckets):
+        """ Take a token from each bucket of a client, and tell whether the request is accepted.
+
+        :param list buckets: The buckets to take a token from, as `(key, capacity, per_minute)`
+                             tuples where `capacity` is the number of requests accepted in a burst
+                             and `per_minute` the number of tokens added to the bucket per minute.
+        :return: 0 if the request is accepted, otherwise the seconds to wait for the next token.
+        :rtype: int
+        """
+        retry_after = 0
+        with shared_state_cursor(self.env) as cr:
+            for key, capacity, per_minute in buckets:
+                rate = per_minute / 60
+                cr.execute(f"""
+                    INSERT INTO payment_ifthenpay_rate_limit AS bucket (key, tokens, allowed, updated_at)
+                         VALUES (%(key)s, %(capacity)s - 1, true, clock_timestamp())
+                    ON CONFLICT (key) DO UPDATE
+                            SET tokens = CASE WHEN {REFILLED_TOKENS} >= 1 THEN {REFILLED_TOKENS} - 1
+                                              ELSE {REFILLED_TOKENS} END,
+                                allowed = {REFILLED_TOKENS} >= 1,
+                                updated_at = clock_timestamp()
+                      RETURNING allowed, tokens
+                """, {'key': key, 'capacity': max(capacity, 1), 'rate': rate})
+                allowed, tokens = cr.fetchone()
+                if not allowed:
+                    retry_after = max(retry_after, math.ceil((1 - tokens) / rate))
+        return retry_after
+
+    @api.autovacuum
+    def _gc_buckets(self):
+        """ Delete the buckets of the clients that have not sent a request for a day. """
+        self.env.cr.execute(
+            "DELETE FROM payment_ifthenpay_rate_limit WHERE updated_at < clock_timestamp() - interval '1 day'"
+        )
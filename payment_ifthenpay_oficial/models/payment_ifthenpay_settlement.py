@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import itertools
+import logging
+import time
+import unicodedata
+
+import psycopg2
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+from odoo.addons.payment_ifthenpay_oficial import const
+
+_logger = logging.getLogger(__name__)
+
+
+class PaymentIfthenpaySettlement(models.Model):
+    _name = 'payment.ifthenpay.settlement'
+    _description = "ifthenpay Settlement Import"
+    _order = 'id desc'
+
+    name = fields.Char(required=True)
+    provider_id = fields.Many2one(
+        'payment.provider', required=True, readonly=True, ondelete='cascade', domain=[('code', '=', 'ifthenpay')],
+    )
+    company_id = fields.Many2one(related='provider_id.company_id')
+    attachment_id = fields.Many2one('ir.attachment', string="File", readonly=True, ondelete='restrict')
+    state = fields.Selection(
+        [('pending', "Pending"), ('running', "Importing"), ('done', "Done"), ('error', "Failed")],
+        default='pending', required=True, readonly=True, index=True,
+    )
+    row_count = fields.Integer(string="Imported Rows", readonly=True)
+    error = fields.Text(readonly=True)
+    line_ids = fields.One2many('payment.ifthenpay.settlement.line', 'settlement_id', string="Rows", readonly=True)
+    matched_count = fields.Integer(string="Matched", compute='_compute_counts')
+    mismatch_count = fields.Integer(string="Amount Mismatch", compute='_compute_counts')
+    unconfirmed_count = fields.Integer(string="Not Confirmed", compute='_compute_counts')
+    missing_count = fields.Integer(string="Missing", compute='_compute_counts')
+
+    def _compute_counts(self):
+        counts = {
+            (settlement, state): count
+            for settlement, state, count in self.env['payment.ifthenpay.settlement.line']._read_group(
+                [('settlement_id', 'in', self._origin.ids)], ['settlement_id', 'state'], ['__count'],
+            )
+        }
+        for settlement in self:
+            settlement.matched_count = counts.get((settlement._origin, 'matched'), 0)
+            settlement.mismatch_count = counts.get((settlement._origin, 'mismatch'), 0)
+            settlement.unconfirmed_count = counts.get((settlement._origin, 'unconfirmed'), 0)
+            settlement.missing_count = counts.get((settlement._origin, 'missing'), 0)
+
+    @api.model
+    def _create_from_file(self, provider, file_name, datas):
+        """ Store a settlement file and schedule its import.
+
+        :param recordset provider: The `payment.provider` the settlement belongs to.
+        :param str file_name: The name of the file.
+        :param bytes datas: The content of the file, base64-encoded.
+        :return: The settlement import.
+        :rtype: recordset of `payment.ifthenpay.settlement`
+        """
+        settlement = self.create({'name': file_name or _("Settlement"), 'provider_id': provider.id})
+        settlement.attachment_id = self.env['ir.attachment'].create({
+            'name': file_name or 'settlement.csv',
+            'datas': datas,
+            'res_model': self._name,
+            'res_id': settlement.id,
+        })
+        self.env.ref('payment_ifthenpay_oficial.cron_ifthenpay_import_settlements')._trigger()
+        return settlement
+
+    def action_retry(self):
+        self.filtered(lambda settlement: settlement.state == 'error').write({'state': 'running', 'error': False})
+        self.env.ref('payment_ifthenpay_oficial.cron_ifthenpay_import_settlements')._trigger()
+
+    def action_view_lines(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': self.name,
+            'res_model': 'payment.ifthenpay.settlement.line',
+            'view_mode': 'list',
+            'domain': [('settlement_id', '=', self.id)],
+            'context': {'search_default_filter_to_check': 1},
+        }
+
+    @api.model
+    def _cron_import(self):
+        """ Import the pending settlement files until the time budget is spent.
+
+        Each chunk of rows is committed on its own together with the number of rows read, so that
+        an interrupted import resumes where it stopped; the run schedules itself again when it runs
+        out of time.
+
+        :return: None
+        """
+        time_budget = int(self.env['ir.config_parameter'].sudo().get_param(
+            'payment_ifthenpay_oficial.settlement_time_budget', 600
+        ))
+        deadline = time.monotonic() + time_budget
+        for settlement in self.search([('state', 'in', ('pending', 'running'))], order='id'):
+            try:
+                settlement._import(deadline)
+            except psycopg2.OperationalError as e:
+                _logger.info("ifthenpay: settlement import %s postponed: %s", settlement.id, e)
+                self.env.cr.rollback()
+            except (UserError, ValueError, csv.Error) as e:
+                self.env.cr.rollback()
+                settlement.write({'state': 'error', 'error': str(e.args[0] if e.args else e)})
+                _logger.warning("ifthenpay: settlement import %s failed: %s", settlement.id, e)
+            except Exception as e:
+                # e.g. the file is missing from the file store: failing keeps the later imports going
+                self.env.cr.rollback()
+                settlement.write({'state': 'error', 'error': str(e)})
+                _logger.exception("ifthenpay: settlement import %s failed: %s", settlement.id, e)
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
+            if time.monotonic() > deadline:
+                self.env.ref('payment_ifthenpay_oficial.cron_ifthenpay_import_settlements')._trigger()
+                break
+
+    def _import(self, deadline):
+        """ Stream the rows of the settlement file and match them with the transactions, chunk by chunk.
+
+        The file is read row by row from the file store and only one chunk of rows is held in memory
+        at a time; the rows imported by a previous run are skipped.
+
+        Note: `self.ensure_one()`
+
+        :param float deadline: The `time.monotonic()` value after which no new chunk is started.
+        :return: None
+        :raise UserError: If the file lacks the reference or the amount column.
+        """
+        self.ensure_one()
+        chunk_size = int(self.env['ir.config_parameter'].sudo().get_param(
+            'payment_ifthenpay_oficial.settlement_batch_size', 2000
+        ))
+        self.state = 'running'
+        with self._open_file() as file:
+            rows = itertools.islice(self._read_rows(file), self.row_count, None)
+            while time.monotonic() < deadline:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    self.state = 'done'
+                    _logger.info("ifthenpay: settlement import %s done, %s rows.", self.id, self.row_count)
+                    break
+                self._import_rows(chunk)
+                self.row_count += len(chunk)
+                if not self.env.registry.in_test_mode():
+                    self.env.cr.commit()
+                # the records of the chunks already imported are not needed anymore
+                self.env.invalidate_all()
+
+    def _open_file(self):
+        """ Open the settlement file for reading, straight from the file store when possible.
+
+        :return: The binary file object.
+        """
+        attachment = self.attachment_id.sudo()
+        if not attachment:
+            raise UserError(_("The settlement file is missing."))
+        if attachment.store_fname:
+            return open(attachment._full_path(attachment.store_fname), 'rb')
+        return io.BytesIO(attachment.raw or b'')
+
+    @api.model
+    def _read_rows(self, file):
+        """ Yield the rows of a settlement CSV file as dicts of the columns in `SETTLEMENT_COLUMNS`.
+
+        The delimiter is guessed from the header, and the empty lines are skipped.
+
+        :param file: The binary file object.
+        :return: The rows, one at a time.
+        :rtype: iterator of dict
+        :raise UserError: If the file lacks the reference or the amount column.
+        """
+        text = io.TextIOWrapper(file, encoding='utf-8-sig', errors='replace', newline='')
+        header_line = text.readline()
+        try:
+            delimiter = csv.Sniffer().sniff(header_line, delimiters=';,\t|').delimiter
+        except csv.Error:
+            delimiter = ';'
+        header = next(csv.reader([header_line], delimiter=delimiter), [])
+
+        columns = {}
+        for index, name in enumerate(header):
+            name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode().strip().lower()
+            for field, names in const.SETTLEMENT_COLUMNS.items():
+                if name in names and field not in columns:
+                    columns[field] = index
+        if 'reference' not in columns or 'amount' not in columns:
+            raise UserError(_(
+                "The settlement file must have a reference and an amount column. Columns found: %s",
+                ", ".join(header),
+            ))
+
+        for row in csv.reader(text, delimiter=delimiter):
+            if not any(value.strip() for value in row):
+                continue
+            yield {field: row[index].strip() if index < len(row) else '' for field, index in columns.items()}
+
+    @api.model
+    def _parse_amount(self, value):
+        """ Return an amount of a settlement file in cents, whatever its decimal separator.
+
+        :param str value: The amount, e.g. `1234.5`, `1.234,50` or `12,50 €`.
+        :return: The amount in cents, or None if it is not a number.
+        :rtype: int
+        """
+        value = ''.join(char for char in value if char.isdigit() or char in ',.-')
+        if ',' in value and '.' in value:
+            if value.rindex(',') > value.rindex('.'):
+                value = value.replace('.', '').replace(',', '.')
+            else:
+                value = value.replace(',', '')
+        else:
+            value = value.replace(',', '.')
+        try:
+            return round(float(value) * 100)
+        except ValueError:
+            return None
+
+    def _index_transactions(self, references):
+        """ Load the ifthenpay transactions of the provider matching the given references, in one query.
+
+        The transactions are matched on `provider_reference`, set when ifthenpay confirms the
+        payment, and on their reference for those not confirmed yet.
+
+        Note: `self.ensure_one()`
+
+        :param set references: The references found in the settlement file.
+        :return: The `(id, amount, confirmed)` of the transactions, by reference.
+        :rtype: dict
+        """
+        self.ensure_one()
+        if not references:
+            return {}
+        self.env['payment.transaction'].flush_model(['reference', 'provider_reference', 'amount', 'state'])
+        self.env.cr.execute("""
+            SELECT id, reference, provider_reference, amount, state
+              FROM payment_transaction
+             WHERE provider_id = %s
+               AND (provider_reference IN %s OR reference IN %s)
+        """, [
+            self.provider_id.id,
+            tuple(f"ifthenpay_{reference}" for reference in references),
+            tuple(references),
+        ])
+        index = {}
+        for tx_id, reference, provider_reference, amount, state in self.env.cr.fetchall():
+            confirmed = state == 'done' and bool(provider_reference)
+            if provider_reference and provider_reference.startswith('ifthenpay_'):
+                index[provider_reference[len('ifthenpay_'):]] = (tx_id, amount, confirmed)
+            index.setdefault(reference, (tx_id, amount, confirmed))
+        return index
+
+    def _import_rows(self, rows):
+        """ Match a chunk of rows with the transactions and store the results in bulk.
+
+        Note: `self.ensure_one()`
+
+        :param list rows: The rows, as returned by `_read_rows`.
+        :return: None
+        """
+        self.ensure_one()
+        Transaction = self.env['payment.transaction']
+        index = self._index_transactions({row['reference'] for row in rows if row['reference']})
+
+        vals_list = []
+        matched_tx_ids = []
+        for sequence, row in enumerate(rows, start=self.row_count + 1):
+            amount = self._parse_amount(row['amount'])
+            tx_id, tx_amount, confirmed = index.get(row['reference'], (False, 0.0, False))
+            if not tx_id:
+                state = 'missing'
+            elif amount is None or amount != Transaction._ifthenpay_to_cents(tx_amount):
+                state = 'mismatch'
+            elif not confirmed:
+                state = 'unconfirmed'
+            else:
+                state = 'matched'
+                matched_tx_ids.append(tx_id)
+            vals_list.append({
+                'settlement_id': self.id,
+                'sequence': sequence,
+                'reference': row['reference'],
+                'amount': (amount or 0) / 100,
+                'payment_date': row.get('payment_date'),
+                'payment_method': row.get('payment_method'),
+                'gateway_txid': row.get('gateway_txid'),
+                'transaction_id': tx_id,
+                'transaction_amount': tx_amount,
+                'state': state,
+            })
+        self.env['payment.ifthenpay.settlement.line'].create(vals_list)
+        Transaction.sudo().browse(matched_tx_ids).write({'ifthenpay_settlement_id': self.id})
+
+
+class PaymentIfthenpaySettlementLine(models.Model):
+    _name = 'payment.ifthenpay.settlement.line'
+    _description = "ifthenpay Settlement Row"
+    _order = 'settlement_id, sequence'
+    _rec_name = 'reference'
+
+    settlement_id = fields.Many2one('payment.ifthenpay.settlement', required=True, ondelete='cascade', index=True)
+    sequence = fields.Integer(string="Row", readonly=True)
+    reference = fields.Char(readonly=True, index=True)
+    amount = fields.Float(readonly=True)
+    payment_date = fields.Char(readonly=True)
+    payment_method = fields.Char(readonly=True)
+    gateway_txid = fields.Char(string="ifthenpay Transaction ID", readonly=True)
+    transaction_id = fields.Many2one('payment.transaction', readonly=True, index='btree_not_null')
+    transaction_amount = fields.Float(readonly=True)
+    state = fields.Selection(
+        [
+            ('matched', "Matched"),
+            ('mismatch', "Amount Mismatch"),
+            ('unconfirmed', "Not Confirmed"),
+            ('missing', "Missing"),
+        ],
+        required=True, readonly=True, index=True,
+    )
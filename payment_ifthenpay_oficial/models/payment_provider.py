@@ -1,16 +1,23 @@
 # -*- coding: utf-8 -*-
+import base64
+import hashlib
 import json
 import requests
-from odoo import models, fields, api, _
+import time
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import UserError
 from odoo.http import request
-from urllib.parse import quote
+from urllib.parse import quote, urlsplit
 import logging
 
-from odoo.addons.payment_ifthenpay_oficial import const
+from odoo.addons.payment_ifthenpay_oficial import client, const, metrics
+from odoo.addons.payment_ifthenpay_oficial.utils import shared_state_cursor
 
 _logger = logging.getLogger(__name__)
 
+# The payment method icons whose download failed recently in this worker, with the time of the failure.
+_icon_download_failures = {}
+
 class PaymentProvider(models.Model):
     _inherit = 'payment.provider'
 
@@ -36,12 +43,190 @@ class PaymentProvider(models.Model):
         help=_("List of accounts or data provided by ifthenpay. One per line."),
         readonly=True
     )
+    ifthenpay_api_url = fields.Char(
+        string=_("API URL"),
+        help=_("Base URL of the ifthenpay API. Only change it to point the provider to a test server or to the bundled simulator."),
+        default=const.API_BASE_URL,
+        required_if_provider='ifthenpay',
+        groups='base.group_system',
+    )
+    ifthenpay_integration_cache_ttl = fields.Integer(
+        string=_("Configuration cache (seconds)"),
+        help=_("How long the configuration returned by ifthenpay is reused before being fetched again. 0 disables the cache."),
+        default=3600,
+    )
+    ifthenpay_timeout_integration = fields.Integer(
+        string=_("Configuration timeout (s)"), default=const.DEFAULT_API_TIMEOUTS['integration'],
+    )
+    ifthenpay_timeout_pinpay = fields.Integer(
+        string=_("Payment creation timeout (s)"), default=const.DEFAULT_API_TIMEOUTS['pinpay'],
+    )
+    ifthenpay_timeout_status = fields.Integer(
+        string=_("Status check timeout (s)"), default=const.DEFAULT_API_TIMEOUTS['status'],
+    )
+    ifthenpay_timeout_methods = fields.Integer(
+        string=_("Payment methods timeout (s)"), default=const.DEFAULT_API_TIMEOUTS['methods'],
+    )
+    ifthenpay_timeout_callback_activation = fields.Integer(
+        string=_("Callback activation timeout (s)"),
+        default=const.DEFAULT_API_TIMEOUTS['callback_activation'],
+    )
+    ifthenpay_max_retries = fields.Integer(
+        string=_("Retries"),
+        help=_("How many times a failed read-only call to ifthenpay is retried. Payment creation is never retried."),
+        default=2,
+    )
+    ifthenpay_methods_refresh_interval = fields.Integer(
+        string=_("Payment methods refresh (seconds)"),
+        help=_("How long the list of payment methods shown at checkout is reused, by Odoo and by the browsers."),
+        default=3600,
+    )
+    ifthenpay_rate_limit_session = fields.Integer(
+        string=_("Requests per minute per visitor"),
+        help=_("How many times a visitor may call each public ifthenpay route per minute. 0 disables the limit."),
+        default=20,
+    )
+    ifthenpay_rate_limit_ip = fields.Integer(
+        string=_("Requests per minute per IP address"),
+        help=_("How many times an IP address may call each public ifthenpay route per minute. 0 disables the limit."),
+        default=120,
+    )
+    ifthenpay_rate_limit_burst = fields.Integer(
+        string=_("Request burst"),
+        help=_("How many requests a visitor or an IP address may send at once before the limits apply."),
+        default=10,
+    )
+    ifthenpay_gateway_origin = fields.Char(
+        help=_("Origin of the Pinpay payment links, which the checkout connects to in advance."),
+        copy=False, readonly=True,
+    )
+    ifthenpay_methods_cache = fields.Json(groups='base.group_user', copy=False, readonly=True)
+    ifthenpay_methods_cache_date = fields.Datetime(groups='base.group_user', copy=False, readonly=True)
+    ifthenpay_notification_backlog = fields.Integer(
+        string=_("Queued callbacks"), compute='_compute_ifthenpay_notification_backlog',
+    )
+    ifthenpay_integration_cache = fields.Json(groups='base.group_user', copy=False, readonly=True)
+    ifthenpay_integration_cache_key = fields.Char(groups='base.group_user', copy=False, readonly=True)
+    ifthenpay_integration_cache_date = fields.Datetime(groups='base.group_user', copy=False, readonly=True)
+    ifthenpay_accounts = fields.Json(
+        string=_("Accounts (structured)"), groups='base.group_user', copy=False, readonly=True,
+        help=_("The entity and sub-entity of each ifthenpay account, as `[{'entity': ..., 'sub_entity': ...}]`."),
+    )
+    ifthenpay_allowed_entities = fields.Json(groups='base.group_user', copy=False, readonly=True)
+    ifthenpay_default_method = fields.Char(
+        string=_("Default payment method"), groups='base.group_user', copy=False, readonly=True,
+    )
+
+    def _compute_ifthenpay_notification_backlog(self):
+        counts = dict(self.env['payment.ifthenpay.notification'].sudo()._read_group(
+            [('provider_id', 'in', self._origin.ids), ('state', '=', 'pending')],
+            ['provider_id'], ['__count'],
+        ))
+        for provider in self:
+            provider.ifthenpay_notification_backlog = counts.get(provider._origin, 0)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        providers = super().create(vals_list)
+        if any(provider.code == 'ifthenpay' for provider in providers):
+            self.env.registry.clear_cache()  # _ifthenpay_get_provider_ids
+        return providers
+
+    def write(self, vals):
+        if 'ifthenpay_api_key' in vals or 'ifthenpay_api_url' in vals:
+            vals = dict(vals, **self._ifthenpay_integration_cache_reset_values())
+        clear_cache = const.PROVIDER_RESOLUTION_FIELDS & vals.keys() and (
+            vals.get('code') == 'ifthenpay' or any(provider.code == 'ifthenpay' for provider in self)
+        )
+        res = super().write(vals)
+        if clear_cache:
+            self.env.registry.clear_cache()  # _ifthenpay_get_provider_ids
+        return res
+
+    def unlink(self):
+        clear_cache = any(provider.code == 'ifthenpay' for provider in self)
+        res = super().unlink()
+        if clear_cache:
+            self.env.registry.clear_cache()  # _ifthenpay_get_provider_ids
+        return res
+
+    def action_ifthenpay_view_circuits(self):
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _("ifthenpay API Status"),
+            'res_model': 'payment.ifthenpay.circuit',
+            'view_mode': 'list',
+        }
+
+    def action_ifthenpay_view_notifications(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _("ifthenpay Callbacks"),
+            'res_model': 'payment.ifthenpay.notification',
+            'view_mode': 'list,form',
+            'domain': [('provider_id', '=', self.id)],
+            'context': {'search_default_filter_pending': 1},
+        }
+
+    @api.model
+    def _ifthenpay_get_provider_from_apk(self, apk):
+        """ Return the ifthenpay provider whose API key matches the anti-phishing key of a callback.
+
+        :param str apk: The anti-phishing key sent by ifthenpay.
+        :return: The matching provider, if any.
+        :rtype: recordset of `payment.provider`
+        """
+        if not apk:
+            return self.browse()
+        return self.sudo().search([
+            ('code', '=', 'ifthenpay'),
+            ('state', '!=', 'disabled'),
+            ('ifthenpay_api_key', '=', apk),
+        ], limit=1)
+
+    @api.model
+    @tools.ormcache('website_id', 'company_id')
+    def _ifthenpay_get_provider_ids(self, website_id, company_id):
+        """ Return the published ifthenpay providers serving a website of a company, memoized per worker.
+
+        The providers dedicated to the website come before those shared by all the websites. The
+        cache is cleared when a provider is created, deleted, or changes in one of the
+        `PROVIDER_RESOLUTION_FIELDS`.
+
+        :param int website_id: The website, or False outside of a website.
+        :param int company_id: The company of the website, or the current company.
+        :return: The ids of the providers, the preferred one first.
+        :rtype: tuple
+        """
+        providers = self.sudo().search([
+            ('code', '=', 'ifthenpay'),
+            ('state', '!=', 'disabled'),
+            ('is_published', '=', True),
+            ('company_id', '=', company_id),
+        ])
+        if 'website_id' in providers._fields:
+            providers = providers.filtered(
+                lambda provider: not provider.website_id or provider.website_id.id == website_id
+            ).sorted(lambda provider: not provider.website_id)
+        return tuple(providers.ids)
 
     def _get_api_url(self):
         self.ensure_one()
         if self.state != 'enabled':
             return None
-        return 'https://api.ifthenpay.com/gateway/pinpay/'
+        return self._ifthenpay_get_api_base_url() + '/gateway/pinpay/'
+
+    def _ifthenpay_get_api_base_url(self):
+        """ Return the base URL of the ifthenpay API, without trailing slash.
+
+        Note: `self.ensure_one()`
+
+        :return: The base URL.
+        :rtype: str
+        """
+        self.ensure_one()
+        return (self.sudo().ifthenpay_api_url or const.API_BASE_URL).rstrip('/')
 
     def _get_pay_form_inputs(self, transaction_values):
         base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
@@ -100,7 +285,71 @@ class PaymentProvider(models.Model):
             'provider_id': self.id,
             'currency_code': currency and currency.name,
         }
+        if self.code == 'ifthenpay':
+            inline_form_values['preconnect_origins'] = self._ifthenpay_get_preconnect_origins()
         return json.dumps(inline_form_values)
+
+    def _ifthenpay_get_preconnect_origins(self):
+        """ Return the origins the checkout should connect to as soon as ifthenpay is selected.
+
+        These are the origin of the Pinpay payment links and those of the payment method icons that
+        are not served by Odoo.
+
+        Note: `self.ensure_one()`
+
+        :return: The origins, e.g. `['https://gateway.example.com']`.
+        :rtype: list
+        """
+        self.ensure_one()
+        provider = self.sudo()
+        urls = [provider.ifthenpay_gateway_origin] + [
+            method.get('SmallImageUrl') for method in provider.ifthenpay_methods_cache or ()
+            if isinstance(method, dict) and not method.get('LocalImageUrl')
+        ]
+        origins = []
+        for url in filter(None, urls):
+            parts = urlsplit(url)
+            origin = parts.scheme in ('http', 'https') and f'{parts.scheme}://{parts.netloc}'
+            if origin and origin not in origins:
+                origins.append(origin)
+        return origins
+
+    def _ifthenpay_update_gateway_origin(self, payment_url):
+        """ Remember the origin of a Pinpay payment link, writing the provider only when it changes.
+
+        Note: `self.ensure_one()`
+
+        :param str payment_url: The payment link returned by ifthenpay.
+        :return: None
+        """
+        self.ensure_one()
+        parts = urlsplit(payment_url)
+        origin = f'{parts.scheme}://{parts.netloc}'
+        if parts.netloc and self.sudo().ifthenpay_gateway_origin != origin:
+            self._ifthenpay_write_shared_state({'ifthenpay_gateway_origin': origin})
+
+    def _ifthenpay_write_shared_state(self, vals):
+        """ Store values cached on the provider in a short side transaction.
+
+        The values are committed right away rather than with the current transaction, so that the
+        provider row is not locked while the checkout runs and the refresh survives its rollback.
+        They are not stored if the row is locked, e.g. by a worker storing the same refresh, but
+        they are put in the cache of the current transaction in any case.
+
+        Note: `self.ensure_one()`
+
+        :param dict vals: The values of the cache fields.
+        :return: None
+        """
+        self.ensure_one()
+        with shared_state_cursor(self.env) as cr:
+            cr.execute(
+                "SELECT id FROM payment_provider WHERE id = %s FOR NO KEY UPDATE SKIP LOCKED", [self.id]
+            )
+            if cr.fetchone():
+                self.with_env(self.env(cr=cr)).sudo().write(vals)
+        # the current transaction may not see the committed values, its snapshot is older
+        self.sudo()._update_cache(vals, validate=False)
     
     def _ifthenpay_api_create_payment_pinpay(self, transaction):
         """
@@ -110,45 +359,42 @@ class PaymentProvider(models.Model):
         :rtype: dict
         """
         self.ensure_one()
-        result = self._get_integration_api(self.ifthenpay_api_key)
+        try:
+            response = self._ifthenpay_send(self._ifthenpay_prepare_pinpay_request(transaction))
+        except requests.exceptions.RequestException as e:
+            _logger.error("Erro de comunicacao com a API ifthenpay: %s", e)
+            raise UserError(_("Unable to connect to ifthenpay. Please try again later."))
+        return self._ifthenpay_parse_pinpay_response(response)
+
+    def _ifthenpay_prepare_pinpay_request(self, transaction):
+        """ Return the arguments of `client.request` creating the Pinpay payment of a transaction.
+
+        Only the reference, the amount and the id of the transaction are read.
+
+        Note: `self.ensure_one()`
+
+        :param recordset transaction: The `payment.transaction` to create the payment for.
+        :return: The keyword arguments of `client.request`.
+        :rtype: dict
+        :raise UserError: If the provider is disabled.
+        """
+        self.ensure_one()
+        result = self._ifthenpay_get_integration_config()
         if result is None:
             raise UserError(_("Unable to connect to ifthenpay because the provider is disabled."))
         
-        api_url = self._get_api_url() + result.get('gatewayKey')
-        if api_url is None:
-            raise UserError(_("Unable to connect to ifthenpay because the provider is disabled."))
-
         base_url = result.get('storeUrl')
-        all_fields_data = transaction.read([])
-
-        selected_data_json_string = result.get('paymentData')
-        payment_method = None
 
+        payment_method = self.sudo().ifthenpay_default_method
 
-        if isinstance(selected_data_json_string, str):
-            try:
-                # Tenta converter a string JSON para um objeto Python
-                selected_data_object = json.loads(selected_data_json_string)
-                
-                # Verifica se é um dicionário e se 'defaultPaymentMethod' existe nele
-                if isinstance(selected_data_object, dict) and 'defaultPaymentMethod' in selected_data_object:
-                    payment_method = selected_data_object['defaultPaymentMethod']
-                else:
-                    _logger.warning("ifthenpay: 'paymentData' eh JSON, mas 'defaultPaymentMethod' nao encontrado ou nao eh um dicionario.")
-            except json.JSONDecodeError:
-                _logger.warning("ifthenpay: 'paymentData' nao eh uma string JSON valida.")
-            except Exception as e:
-                _logger.error("ifthenpay: Erro inesperado ao processar 'paymentData': %s", e)
-        else:
-            _logger.warning("ifthenpay: 'paymentData' nao eh uma string.")
-
-        cancel_url = quote(f"{base_url}/payment/ifthenpay/iframe_redirect?reference={transaction.reference}&amount={transaction.amount}&status=cancel")
-        error_url = quote(f"{base_url}/payment/ifthenpay/iframe_redirect?reference={transaction.reference}&amount={transaction.amount}&status=error")
-        success_url = quote(f"{base_url}/payment/ifthenpay/iframe_redirect?reference={transaction.reference}&amount={transaction.amount}&status=success&txid=[TRANSACTIONID]")
+        reference, amount = transaction.reference, transaction.amount
+        cancel_url = quote(f"{base_url}{const.RETURN_PAGE_PATH}?reference={reference}&amount={amount}&status=cancel&txid=[TRANSACTIONID]")
+        error_url = quote(f"{base_url}{const.RETURN_PAGE_PATH}?reference={reference}&amount={amount}&status=error&txid=[TRANSACTIONID]")
+        success_url = quote(f"{base_url}{const.RETURN_PAGE_PATH}?reference={reference}&amount={amount}&status=success&txid=[TRANSACTIONID]")
 
         ifthenpay_payload = {
-            'id': transaction.reference,
-            'amount': "%.2f" % transaction.amount,
+            'id': reference,
+            'amount': "%.2f" % amount,
             'description': transaction.id,
             'accounts': result.get('accountKeys'),
             'selected_method': None,
@@ -163,8 +409,20 @@ class PaymentProvider(models.Model):
         if payment_method:
             ifthenpay_payload['selected_method'] = payment_method
 
+        return self._ifthenpay_prepare_request(
+            'pinpay', path_params={'gateway_key': result.get('gatewayKey')}, json=ifthenpay_payload,
+        )
+
+    @api.model
+    def _ifthenpay_parse_pinpay_response(self, response):
+        """ Return the payment URL from the response of the Pinpay endpoint.
+
+        :param requests.Response response: The response of the Pinpay endpoint.
+        :return: A dictionary with the payment URL and the raw response of ifthenpay.
+        :rtype: dict
+        :raise UserError: If the payment was not created.
+        """
         try:
-            response = requests.post(api_url, json=ifthenpay_payload, timeout=30)
             response.raise_for_status() # Lança um HTTPError para respostas de erro (4xx ou 5xx)
             api_response = response.json()
 
@@ -175,19 +433,338 @@ class PaymentProvider(models.Model):
                 _logger.error("Erro da API ifthenpay: %s - Resposta completa: %s", error_msg, api_response)
                 raise UserError(_("Failed to create ifthenpay payment: %s") % error_msg)
 
-        except requests.exceptions.RequestException as e:
-            _logger.error("Erro de comunicacao com a API ifthenpay: %s", e)
-            raise UserError(_("Unable to connect to ifthenpay. Please try again later."))
         except json.JSONDecodeError as e:
+            metrics.count('api_error', 'pinpay', 'json_error')
             _logger.error("Falha ao decodificar a resposta da API ifthenpay: %s", e)
             raise UserError(_("Invalid response from ifthenpay. Please contact support."))
+        except requests.exceptions.RequestException as e:
+            _logger.error("Erro de comunicacao com a API ifthenpay: %s", e)
+            raise UserError(_("Unable to connect to ifthenpay. Please try again later."))
     
+    def _ifthenpay_make_request(self, endpoint, path_params=None, **kwargs):
+        """ Send a request to an ifthenpay API endpoint through the pooled HTTP client.
+
+        The timeout of the endpoint is read from the provider and idempotent endpoints are retried
+        up to `ifthenpay_max_retries` times.
+
+        :param str endpoint: The endpoint, as a key of `const.API_ENDPOINTS`.
+        :param dict path_params: The values to format the path of the endpoint with.
+        :param dict kwargs: The extra arguments passed to `requests`, e.g. `params` or `json`.
+        :return: The response of the API.
+        :rtype: requests.Response
+        :raise requests.exceptions.RequestException: If the API could not be reached.
+        """
+        return self._ifthenpay_send(self._ifthenpay_prepare_request(endpoint, path_params, **kwargs))
+
+    def _ifthenpay_send(self, request_kwargs):
+        """ Send a prepared request, unless the circuit breaker of its endpoint is open.
+
+        :param dict request_kwargs: The keyword arguments of `client.request`.
+        :return: The response of the API.
+        :rtype: requests.Response
+        :raise requests.exceptions.RequestException: If the API could not be reached, or
+                                                      `client.CircuitOpenError` if it was not tried.
+        """
+        endpoint = request_kwargs['endpoint']
+        Circuit = self.env['payment.ifthenpay.circuit'].sudo()
+        if not Circuit._allow(endpoint):
+            metrics.count('api_error', endpoint, 'circuit_open')
+            raise client.CircuitOpenError(f"ifthenpay: the {endpoint} endpoint is unavailable.")
+        try:
+            response = client.request(**request_kwargs)
+        except requests.exceptions.RequestException:
+            Circuit._record(endpoint, success=False)
+            raise
+        finally:
+            self.env['payment.ifthenpay.metric'].sudo()._flush()
+        Circuit._record(endpoint, success=not client.is_failure(response))
+        return response
+
+    def _ifthenpay_prepare_request(self, endpoint, path_params=None, **kwargs):
+        """ Return the arguments of `client.request` for a call to an ifthenpay API endpoint.
+
+        The arguments only hold plain values, so that the request can be sent from a thread that has
+        no access to the environment.
+
+        :param str endpoint: The endpoint, as a key of `const.API_ENDPOINTS`.
+        :param dict path_params: The values to format the path of the endpoint with.
+        :param dict kwargs: The extra arguments passed to `requests`, e.g. `params` or `json`.
+        :return: The keyword arguments of `client.request`.
+        :rtype: dict
+        """
+        method, path, idempotent = const.API_ENDPOINTS[endpoint]
+        return dict(
+            kwargs,
+            endpoint=endpoint,
+            method=method,
+            url=self._ifthenpay_get_api_base_url() + path.format(**(path_params or {})),
+            timeout=self[f'ifthenpay_timeout_{endpoint}'] or const.DEFAULT_API_TIMEOUTS[endpoint],
+            idempotent=idempotent,
+            max_retries=max(self.ifthenpay_max_retries, 0),
+        )
+
+    @api.model
+    def _get_compatible_providers(self, *args, **kwargs):
+        """ Override of `payment` to hide ifthenpay while its payment creation endpoint is down. """
+        providers = super()._get_compatible_providers(*args, **kwargs)
+        if 'ifthenpay' in providers.mapped('code') and self.env['payment.ifthenpay.circuit'].sudo()._is_open('pinpay'):
+            _logger.info("ifthenpay: hidden from the checkout while the API is unavailable.")
+            providers = providers.filtered(lambda p: p.code != 'ifthenpay')
+        return providers
+
     def _get_payment_flow(self):
         if self.code == 'ifthenpay':
             _logger.info(">>>>> Usando fluxo INLINE para ifthenpay (ID: %s)", self.id)
             return 'direct'
         return super()._get_payment_flow()
     
+    @api.model
+    def _ifthenpay_integration_cache_key(self, token):
+        return hashlib.sha256((token or '').encode()).hexdigest()
+
+    @api.model
+    def _ifthenpay_integration_cache_reset_values(self):
+        return {
+            'ifthenpay_integration_cache': False,
+            'ifthenpay_integration_cache_key': False,
+            'ifthenpay_integration_cache_date': False,
+            'ifthenpay_accounts': False,
+            'ifthenpay_allowed_entities': False,
+            'ifthenpay_default_method': False,
+            'ifthenpay_methods_cache': False,
+            'ifthenpay_methods_cache_date': False,
+            'ifthenpay_gateway_origin': False,
+        }
+
+    def _ifthenpay_get_integration_config(self, force_refresh=False):
+        """ Return the cmsintegration payload of the provider, served from the cache while fresh.
+
+        The payload is stored on the provider record so that it is shared between workers. It is
+        keyed on the API key and refreshed once older than `ifthenpay_integration_cache_ttl`. When
+        ifthenpay cannot be reached, the last known-good payload is returned instead.
+
+        Note: `self.ensure_one()`
+
+        :param bool force_refresh: Whether the cached payload must be ignored.
+        :return: The integration payload, or None if the provider is disabled.
+        :rtype: dict
+        """
+        self.ensure_one()
+        if self.state != 'enabled':
+            return None
+
+        provider = self.sudo()
+        cache_key = self._ifthenpay_integration_cache_key(provider.ifthenpay_api_key)
+        cached = None
+        if provider.ifthenpay_integration_cache_key == cache_key:
+            cached = provider.ifthenpay_integration_cache
+
+        if cached and not isinstance(provider.ifthenpay_accounts, list):
+            # the payload was cached before the accounts were structured
+            provider._ifthenpay_write_shared_state(self._ifthenpay_parse_integration(cached))
+
+        if cached and not force_refresh and provider.ifthenpay_integration_cache_date:
+            age = (fields.Datetime.now() - provider.ifthenpay_integration_cache_date).total_seconds()
+            if age < provider.ifthenpay_integration_cache_ttl:
+                return cached
+
+        try:
+            result = provider._get_integration_api(provider.ifthenpay_api_key)
+        except UserError:
+            if cached:
+                _logger.warning("ifthenpay: API unreachable, using the last known configuration for provider %s.", self.id)
+                return cached
+            raise
+
+        if result is not None:
+            provider._ifthenpay_write_shared_state(dict(
+                self._ifthenpay_parse_integration(result),
+                ifthenpay_integration_cache=result,
+                ifthenpay_integration_cache_key=cache_key,
+                ifthenpay_integration_cache_date=fields.Datetime.now(),
+            ))
+        return result
+
+    @api.model
+    def _ifthenpay_parse_integration(self, result):
+        """ Return the structured account configuration of a cmsintegration payload.
+
+        The payload is parsed once when it is fetched so that the checkout reads the accounts, the
+        allowed entities and the default payment method directly from the provider.
+
+        :param dict result: The cmsintegration payload.
+        :return: The values of `ifthenpay_accounts`, `ifthenpay_allowed_entities` and
+                 `ifthenpay_default_method`.
+        :rtype: dict
+        """
+        accounts = []
+        for part in (result.get('accountKeys') or '').split(";"):
+            part = part.strip()
+            if not part:
+                continue
+            entity, _sep, sub_entity = part.partition("|")
+            accounts.append({'entity': entity.strip(), 'sub_entity': sub_entity.strip()})
+
+        # numeric entities are Multibanco accounts
+        allowed_entities = {account['entity'].upper() for account in accounts}
+        if any(entity.isdigit() for entity in allowed_entities):
+            allowed_entities.add("MB")
+
+        selected_data_json_string = result.get('paymentData')
+        payment_method = None
+
+        if isinstance(selected_data_json_string, str):
+            try:
+                # Tenta converter a string JSON para um objeto Python
+                selected_data_object = json.loads(selected_data_json_string)
+                
+                # Verifica se é um dicionário e se 'defaultPaymentMethod' existe nele
+                if isinstance(selected_data_object, dict) and 'defaultPaymentMethod' in selected_data_object:
+                    payment_method = selected_data_object['defaultPaymentMethod']
+                else:
+                    _logger.warning("ifthenpay: 'paymentData' eh JSON, mas 'defaultPaymentMethod' nao encontrado ou nao eh um dicionario.")
+            except json.JSONDecodeError:
+                _logger.warning("ifthenpay: 'paymentData' nao eh uma string JSON valida.")
+            except Exception as e:
+                _logger.error("ifthenpay: Erro inesperado ao processar 'paymentData': %s", e)
+        else:
+            _logger.warning("ifthenpay: 'paymentData' nao eh uma string.")
+
+        return {
+            'ifthenpay_accounts': accounts,
+            'ifthenpay_allowed_entities': sorted(allowed_entities),
+            'ifthenpay_default_method': payment_method and str(payment_method),
+        }
+
+    def _ifthenpay_get_available_methods(self, force_refresh=False):
+        """ Return the gateway payment methods enabled on the ifthenpay accounts of the provider.
+
+        The filtered list is stored on the provider and refreshed once older than
+        `ifthenpay_methods_refresh_interval`. When ifthenpay cannot be reached, the stored list is
+        returned instead.
+
+        Note: `self.ensure_one()`
+
+        :param bool force_refresh: Whether the stored list must be ignored.
+        :return: The payment methods, as returned by ifthenpay, or None if the provider is disabled.
+        :rtype: list
+        :raise UserError: If ifthenpay cannot be reached and no list is stored.
+        """
+        self.ensure_one()
+        provider = self.sudo()
+        cached = provider.ifthenpay_methods_cache
+        if isinstance(cached, list) and not force_refresh and provider.ifthenpay_methods_cache_date:
+            age = (fields.Datetime.now() - provider.ifthenpay_methods_cache_date).total_seconds()
+            if age < provider.ifthenpay_methods_refresh_interval:
+                return cached
+
+        integration = provider._ifthenpay_get_integration_config()
+        if integration is None:
+            return None
+
+        try:
+            response = provider._ifthenpay_make_request('methods')
+            response.raise_for_status()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if isinstance(e, ValueError):
+                metrics.count('api_error', 'methods', 'json_error')
+            _logger.error("Erro de comunicacao com a API ifthenpay: %s", e)
+            data = None
+
+        if not isinstance(data, list):
+            if isinstance(cached, list):
+                _logger.warning("ifthenpay: API unreachable, using the last known payment methods for provider %s.", self.id)
+                return cached
+            raise UserError(_("Unable to connect to ifthenpay."))
+
+        methods = self._ifthenpay_filter_available_methods(data, provider.ifthenpay_allowed_entities)
+        provider._ifthenpay_store_method_icons(methods)
+        provider._ifthenpay_write_shared_state({
+            'ifthenpay_methods_cache': methods,
+            'ifthenpay_methods_cache_date': fields.Datetime.now(),
+        })
+        return methods
+
+    @api.model
+    def _ifthenpay_filter_available_methods(self, methods, allowed_entities):
+        """ Keep the gateway payment methods for which the account has an entity.
+
+        :param list methods: The payment methods returned by ifthenpay.
+        :param list allowed_entities: The upper-cased entities of the accounts.
+        :return: The filtered payment methods.
+        :rtype: list
+        """
+        allowed_entities = set(allowed_entities or ())
+        return [m for m in methods if m.get("Entity", "").upper() in allowed_entities]
+
+    def _ifthenpay_store_method_icons(self, methods):
+        """ Download the icons of the payment methods once and serve them from Odoo.
+
+        Each method gets a `LocalImageUrl` pointing to `/payment/ifthenpay/method_icon`, and an
+        `ImageData` data URI for small icons, so that the checkout does not depend on the CDN of
+        ifthenpay. Icons that cannot be downloaded keep their original URL, and are not tried again
+        for a while so that an unavailable CDN does not hold up the requests listing the methods.
+
+        Note: `self.ensure_one()`
+
+        :param list methods: The payment methods, updated in place.
+        :return: None
+        """
+        self.ensure_one()
+        names = {
+            method['SmallImageUrl']: 'ifthenpay_icon_%s' % hashlib.sha1(method['SmallImageUrl'].encode()).hexdigest()
+            for method in methods if method.get('SmallImageUrl')
+        }
+        if not names:
+            return
+
+        Attachment = self.env['ir.attachment'].sudo()
+        attachments = {
+            attachment.name: attachment for attachment in Attachment.search([
+                ('res_model', '=', self._name),
+                ('res_id', '=', self.id),
+                ('name', 'in', list(names.values())),
+            ])
+        }
+        now = time.monotonic()
+        downloads = [
+            (url, name) for url, name in names.items()
+            if name not in attachments
+            and now - _icon_download_failures.get(url, float('-inf')) >= const.METHOD_ICON_RETRY_DELAY
+        ]
+        Circuit = self.env['payment.ifthenpay.circuit'].sudo()
+        if downloads and Circuit._allow('method_icon'):
+            results = client.request_many([
+                {'endpoint': 'method_icon', 'method': 'GET', 'url': url, 'timeout': const.METHOD_ICON_TIMEOUT}
+                for url, _name in downloads
+            ], const.METHOD_ICON_MAX_WORKERS)
+            Circuit._record('method_icon', success=not all(client.is_failure(result) for result in results))
+            for (url, name), result in zip(downloads, results):
+                if isinstance(result, Exception) or result.status_code != 200:
+                    _logger.warning("ifthenpay: could not download the payment method icon %s: %s", url, result)
+                    _icon_download_failures[url] = now
+                    continue
+                _icon_download_failures.pop(url, None)
+                attachments[name] = Attachment.create({
+                    'name': name,
+                    'raw': result.content,
+                    'description': url,
+                    'res_model': self._name,
+                    'res_id': self.id,
+                    'public': True,
+                })
+
+        for method in methods:
+            attachment = attachments.get(names.get(method.get('SmallImageUrl')))
+            if not attachment:
+                continue
+            method['LocalImageUrl'] = '/payment/ifthenpay/method_icon/%s/%s' % (attachment.id, attachment.checksum)
+            if attachment.file_size <= const.METHOD_ICON_INLINE_MAX_SIZE:
+                method['ImageData'] = 'data:%s;base64,%s' % (
+                    attachment.mimetype, base64.b64encode(attachment.raw).decode()
+                )
+
     def _get_integration_api(self, token):
         self.ensure_one()
         try:
@@ -195,9 +772,7 @@ class PaymentProvider(models.Model):
                 _logger.error("Erro por nao habilitar provider")
                 return None
 
-            url = f'https://api.ifthenpay.com/v2/cmsintegration/get/{token}/odoo'
-
-            response = requests.post(url, timeout=60)
+            response = self._ifthenpay_make_request('integration', path_params={'token': token})
             response.raise_for_status()
             api_response = response.json()
 
@@ -208,12 +783,13 @@ class PaymentProvider(models.Model):
                 _logger.error("Erro da API ifthenpay: %s - Resposta completa: %s", error_msg, api_response)
                 raise UserError(_("Failed to create ifthenpay payment: %s") % error_msg)
 
-        except requests.exceptions.RequestException as e:
-            _logger.error("Erro de comunicação com a API ifthenpay: %s", e)
-            raise UserError(_("Unable to connect to ifthenpay."))
         except json.JSONDecodeError as e:
+            metrics.count('api_error', 'integration', 'json_error')
             _logger.error("Falha ao decodificar a resposta da API ifthenpay: %s", e)
             raise UserError(_("Invalid response from ifthenpay. Please contact support."))
+        except requests.exceptions.RequestException as e:
+            _logger.error("Erro de comunicação com a API ifthenpay: %s", e)
+            raise UserError(_("Unable to connect to ifthenpay."))
     
     @api.onchange('ifthenpay_api_key')
     def _onchange_ifthenpay_api_token(self):
@@ -231,13 +807,10 @@ class PaymentProvider(models.Model):
             if result is None:
                 raise UserError(_("Unable to connect to ifthenpay because the provider is disabled."))
             
-            accounts = result.get('accountKeys')
-
-            cleaned_lines = []
-            for part in accounts.split(";"):
-                cleaned_lines.append(part.strip()) 
-
-            self.ifthenpay_accounts_info = "\n".join(cleaned_lines)
+            accounts = self._ifthenpay_parse_integration(result)['ifthenpay_accounts']
+            self.ifthenpay_accounts_info = "\n".join(
+                "|".join(filter(None, (account['entity'], account['sub_entity']))) for account in accounts
+            )
 
             base_url = result.get('storeUrl')
             self.ifthenpay_store_name = result.get('storeName')
@@ -253,7 +826,9 @@ class PaymentProvider(models.Model):
                 'chave': result.get('gatewayKey'),
                 'urlCb': base_url + callback
             }
-            response = requests.post('https://api.ifthenpay.com/endpoint/callback/activation/?cms=odoo', json=payload, timeout=30)
+            response = self._ifthenpay_make_request(
+                'callback_activation', params={'cms': 'odoo'}, json=payload,
+            )
             response.raise_for_status()
             api_response = response.json()
             _logger.info("ifthenpay: active callback %s", api_response)
@@ -1,15 +1,47 @@
 # -*- coding: utf-8 -*-
+import codecs
+import csv
+import io
+import psycopg2
 import requests
-import time
 import logging
-from odoo import models, fields, _
+import time
+from collections import defaultdict
+from datetime import timedelta
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import UserError
+from odoo.tools import float_repr
+
+from odoo.addons.payment_ifthenpay_oficial import client, const
 
 _logger = logging.getLogger(__name__)
 
 class PaymentTransaction(models.Model):
     _inherit = 'payment.transaction'
 
+    ifthenpay_txid = fields.Char(string="ifthenpay Transaction ID", readonly=True, copy=False)
+    ifthenpay_poll_attempts = fields.Integer(readonly=True, copy=False)
+    ifthenpay_poll_next_date = fields.Datetime(readonly=True, copy=False, index='btree_not_null')
+    ifthenpay_notification_key = fields.Char(readonly=True, copy=False, index='btree_not_null')
+    ifthenpay_pinpay_url = fields.Char(string="ifthenpay Payment Link", readonly=True, copy=False)
+    ifthenpay_pinpay_date = fields.Datetime(string="ifthenpay Payment Link Date", readonly=True, copy=False)
+    ifthenpay_pinpay_amount = fields.Monetary(readonly=True, copy=False)
+    ifthenpay_expiry_date = fields.Datetime(
+        string="ifthenpay Payment Link Expiry", readonly=True, copy=False, index='btree_not_null',
+    )
+    ifthenpay_settlement_id = fields.Many2one(
+        'payment.ifthenpay.settlement', string="ifthenpay Settlement", readonly=True, copy=False,
+        index='btree_not_null', ondelete='set null',
+    )
+
+    def init(self):
+        super().init()
+        # the settlement imports match the transactions on their provider reference
+        tools.create_index(
+            self.env.cr, 'payment_transaction_ifthenpay_provider_reference_index',
+            self._table, ['provider_reference'], where='provider_reference IS NOT NULL',
+        )
+
     def _get_tx_from_notification_data(self, provider_code, notification_data):
         """ Override of `payment` to find the transaction based on ifthenpay notification data.
 
@@ -31,11 +63,7 @@ class PaymentTransaction(models.Model):
             _logger.error("ifthenpay: Missing reference in notification data: %s", notification_data)
             raise UserError(_("Missing reference in payment notification data."))
 
-        tx = self.sudo().search([
-            ('reference', '=', reference),
-            ('provider_code', '=', 'ifthenpay'),
-            ('amount', '=', amount),
-        ], limit=1)
+        tx = self._ifthenpay_get_tx_by_reference(reference, amount)
 
         if not tx:
             _logger.error("ifthenpay: Transaction not found for reference %s and amount %s.", 
@@ -55,6 +83,14 @@ class PaymentTransaction(models.Model):
         if self.provider_code != 'ifthenpay':
             return
 
+        # the s2s callback, its retries and the status lookup can notify the same payment concurrently
+        self._ifthenpay_lock()
+        notification_key = self._ifthenpay_get_notification_key(notification_data)
+        if self.state == 'done' or self.ifthenpay_notification_key == notification_key:
+            _logger.info("ifthenpay: Notification %s already applied to transaction %s.", notification_key, self.reference)
+            return
+        self.ifthenpay_notification_key = notification_key
+
         ifthenpay_payment_amount = float(notification_data.get('amount', 0.0))
         token = notification_data.get('apk')
         
@@ -62,11 +98,13 @@ class PaymentTransaction(models.Model):
                 _logger.warning("ifthenpay_s2s_callback: Token recebido (%s) NAO CORRESPONDE a API Key configurada para a transacao %s. POSSIVEL TENTATIVA DE FRAUDE.",
                             token, self.reference)
                 self._set_error(_("Error: Invalid Token"))
+                self._ifthenpay_notify_status()
                 return
 
         if abs(ifthenpay_payment_amount - self.amount) > 0.001:
             _logger.warning("ifthenpay: Amount mismatch for transaction %s.", self.reference)
             self._set_error(_("Amount mismatch from ifthenpay notification."))
+            self._ifthenpay_notify_status()
             return
 
         reference = notification_data.get('reference')
@@ -74,34 +112,587 @@ class PaymentTransaction(models.Model):
 
         self._set_done()
 
-        if 'inv' in reference.lower():
+        if 'inv' in reference.lower() and not self.payment_id:
             _logger.info("ifthenpay: Transaction invoice %s processed", self.reference)
             self._create_payment()
 
+        self._ifthenpay_notify_status()
         _logger.info("ifthenpay: Transaction %s processed. New state: %s", self.reference, self.state)
 
-    def _ifthenpay_poll_status(self, tx_id_ifthen, max_attempts=10, wait_seconds=1):
-        url = f'https://api.ifthenpay.com/gateway/transaction/status/get?transactionId={tx_id_ifthen}'
+    def _ifthenpay_get_checkout_status(self):
+        """ Return the status of the transaction as understood by the checkout.
+
+        Note: `self.ensure_one()`
+
+        :return: The status, and a message for the states that need one.
+        :rtype: dict
+        """
+        self.ensure_one()
+        if self.state == 'done':
+            return {'status': 'success'}
+        elif self.state == 'pending':
+            return {'status': 'pending'}
+        elif self.state == 'cancel':
+            return {'status': 'error', 'message': 'Pagamento cancelado.'}
+        elif self.state == 'error':
+            return {'status': 'error', 'message': 'Erro no pagamento.'}
+        else: # draft, authorized, etc. - assume que não foi concluído ainda
+            return {'status': 'processing', 'message': 'Aguardando confirmacao do pagamento.'}
+
+    def _ifthenpay_get_bus_channel(self):
+        """ Return the bus channel on which the status changes of the transaction are published.
+
+        The channel is derived from the reference with a secret so that it cannot be guessed.
+
+        Note: `self.ensure_one()`
+
+        :return: The channel name.
+        :rtype: str
+        """
+        self.ensure_one()
+        return 'ifthenpay_tx_%s' % tools.hmac(self.env(su=True), 'payment_ifthenpay_oficial.bus', self.reference)
+
+    def _ifthenpay_notify_status(self):
+        """ Publish the status of the transaction to the checkout waiting for it.
+
+        Note: `self.ensure_one()`
+
+        :return: None
+        """
+        self.ensure_one()
+        self.env['bus.bus'].sudo()._sendone(
+            self._ifthenpay_get_bus_channel(),
+            'ifthenpay_tx_status',
+            dict(self._ifthenpay_get_checkout_status(), reference=self.reference),
+        )
+
+    def _ifthenpay_get_pinpay_url(self):
+        """ Return the Pinpay payment link of the transaction, creating it only when needed.
+
+        The link is stored on the transaction and reused by the following submits until it expires,
+        the amount changes or the transaction leaves the draft and pending states.
+
+        Note: `self.ensure_one()`
+
+        :return: The payment link.
+        :rtype: str
+        :raise UserError: If the payment could not be created at ifthenpay.
+        """
+        self.ensure_one()
+        if self._ifthenpay_is_pinpay_url_valid():
+            return self.ifthenpay_pinpay_url
+
+        api_response = self.provider_id._ifthenpay_api_create_payment_pinpay(self)
+        payment_url = api_response.get('payment_url')
+        if payment_url:
+            self._ifthenpay_set_pinpay_url(payment_url)
+        return payment_url
+
+    def _ifthenpay_set_pinpay_url(self, payment_url):
+        """ Store the Pinpay payment link created for the transaction, with its expiry date.
+
+        Note: `self.ensure_one()`
+
+        :param str payment_url: The payment link returned by ifthenpay.
+        :return: None
+        """
+        self.ensure_one()
+        now = fields.Datetime.now()
+        self.write({
+            'ifthenpay_pinpay_url': payment_url,
+            'ifthenpay_pinpay_date': now,
+            'ifthenpay_pinpay_amount': self.amount,
+            'ifthenpay_expiry_date': now + timedelta(days=self._ifthenpay_get_expiry_days()),
+        })
+        self.provider_id._ifthenpay_update_gateway_origin(payment_url)
+
+    def _ifthenpay_is_pinpay_url_valid(self):
+        self.ensure_one()
+        if not self.ifthenpay_pinpay_url or self.state not in ('draft', 'pending'):
+            return False
+        if self.currency_id.compare_amounts(self.ifthenpay_pinpay_amount, self.amount) != 0:
+            return False
+        return bool(self.ifthenpay_expiry_date) and fields.Datetime.now() < self.ifthenpay_expiry_date
 
-        attempts = 0
-        while attempts < max_attempts:
+    def _ifthenpay_get_expiry_days(self):
+        self.ensure_one()
+        expiry_days = self.provider_id.sudo().ifthenpay_expiry_days
+        try:
+            expiry_days = int(expiry_days)
+        except (TypeError, ValueError):
+            expiry_days = 0
+        return expiry_days if expiry_days > 0 else const.PINPAY_DEFAULT_EXPIRY_DAYS
+
+    def _ifthenpay_lock(self):
+        """ Lock the row of the transaction until the end of the database transaction.
+
+        A concurrent notification of the same payment waits for the lock, then fails with a
+        serialization error and is retried by its caller, at which point it is deduplicated.
+
+        Note: `self.ensure_one()`
+
+        :return: None
+        """
+        self.ensure_one()
+        self.env.cr.execute(
+            "SELECT id FROM payment_transaction WHERE id = %s FOR NO KEY UPDATE", [self.id]
+        )
+        self.invalidate_recordset(['state', 'ifthenpay_notification_key', 'payment_id'])
+
+    @api.model
+    def _ifthenpay_get_notification_key(self, notification_data):
+        """ Return the deduplication key of an ifthenpay notification.
+
+        :param dict notification_data: The notification data sent by ifthenpay.
+        :return: The key, made of the reference, the amount in cents and the gateway transaction id.
+        :rtype: str
+        """
+        amount_cents = self._ifthenpay_to_cents(notification_data.get('amount'))
+        return '%s|%s|%s' % (notification_data.get('reference'), amount_cents, notification_data.get('txid') or '')
+
+    @api.model
+    def _ifthenpay_to_cents(self, amount):
+        return round(float(amount or 0.0) * 100)
+
+    @api.model
+    def _ifthenpay_get_tx_by_reference(self, reference, amount=None):
+        """ Return the ifthenpay transaction with the given reference.
+
+        The transaction is searched on its reference only, which is unique and indexed, and the
+        provider and the amount are checked on the record found. The lookup is memoized until the
+        end of the database transaction so that a request resolving the same reference several times
+        only searches once.
+
+        :param str reference: The reference of the transaction.
+        :param amount: The expected amount, compared in cents, or None to skip the check.
+        :return: The transaction, or an empty recordset if none matches.
+        :rtype: recordset of `payment.transaction`
+        """
+        if not reference:
+            return self.browse()
+        memo = self.env.cr.precommit.data.setdefault('payment_ifthenpay_oficial.tx_by_reference', {})
+        if reference not in memo:
+            memo[reference] = self.sudo().search([('reference', '=', reference)], limit=1).id
+        tx = self.sudo().browse(memo[reference])
+        if not tx or tx.provider_code != 'ifthenpay':
+            return self.browse()
+        if amount is not None:
             try:
-                response = requests.get(url, timeout=30)
+                amount_cents = self._ifthenpay_to_cents(amount)
+            except (TypeError, ValueError, OverflowError):  # e.g. a malformed amount in the query string
+                return self.browse()
+            if amount_cents != self._ifthenpay_to_cents(tx.amount):
+                return self.browse()
+        return tx
 
-                if response.status_code == 404:
-                    _logger.info("Tentativa %s/%s: transacao ainda nao encontrada (404).", attempts + 1, max_attempts)
-                    attempts += 1
-                    time.sleep(wait_seconds)
-                    continue
+    def _ifthenpay_schedule_status_poll(self, tx_id_ifthen):
+        """ Schedule the background lookup of the gateway status of the transaction.
+
+        The status is fetched by `_cron_ifthenpay_poll_status` so that the HTTP worker serving the
+        customer's return does not wait for ifthenpay.
+
+        Note: `self.ensure_one()`
+
+        :param str tx_id_ifthen: The transaction id of the gateway.
+        :return: None
+        """
+        self.ensure_one()
+        self.write({
+            'ifthenpay_txid': tx_id_ifthen,
+            'ifthenpay_poll_attempts': 0,
+            'ifthenpay_poll_next_date': fields.Datetime.now(),
+        })
+        self.env.ref('payment_ifthenpay_oficial.cron_ifthenpay_poll_status')._trigger()
+
+    def _ifthenpay_fetch_status(self, tx_id_ifthen):
+        """ Fetch the status of a gateway transaction, in a single attempt.
+
+        :param str tx_id_ifthen: The transaction id of the gateway.
+        :return: The status data, or None if the gateway does not know the transaction (yet).
+        :rtype: dict
+        :raise requests.exceptions.RequestException: If the API could not be reached.
+        """
+        response = self.provider_id._ifthenpay_make_request('status', params={'transactionId': tx_id_ifthen})
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            _logger.warning("Resposta inesperada %s para transacao %s", response.status_code, tx_id_ifthen)
+            return None
+        return response.json()
+
+    def _ifthenpay_match_gateway_status(self, data):
+        """ Check that the status data of the gateway belong to the transaction.
+
+        The gateway transaction id may come from the customer's browser, so the status is only
+        trusted if the order id, the amount and the currency it reports are the transaction's.
+
+        Note: `self.ensure_one()`
+
+        :param dict data: The status data returned by ifthenpay.
+        :return: Whether the data match the transaction.
+        :rtype: bool
+        """
+        self.ensure_one()
+        currency = data.get('Currency') or data.get('currency')
+        try:
+            matches = (
+                str(data.get('OrderId') or '') == self.reference
+                and self._ifthenpay_to_cents(data.get('Amount')) == self._ifthenpay_to_cents(self.amount)
+                and (not currency or currency == self.currency_id.name)
+            )
+        except (TypeError, ValueError, OverflowError):
+            matches = False
+        if not matches:
+            _logger.warning(
+                "ifthenpay: status of gateway transaction %s (order %s, amount %s) does not match transaction %s, ignored.",
+                self.ifthenpay_txid, data.get('OrderId'), data.get('Amount'), self.reference,
+            )
+        return matches
 
-                if response.status_code == 200:
-                    return response.json()
+    def _ifthenpay_poll_status(self):
+        """ Fetch the gateway status of the transaction once and process it.
 
-                _logger.warning("Resposta inesperada %s para transacao %s", response.status_code, tx_id_ifthen)
-                return None
+        Card, Apple Pay and Google Pay payments are final as soon as the gateway knows them and are
+        confirmed right away. Other methods stay pending until the callback is received. While the
+        gateway does not know the transaction, the next attempt is scheduled with a backoff.
 
-            except requests.exceptions.RequestException as e:
-                _logger.error("Erro na requisicao ao ifthenpay: %s", e)
-                return None
+        Note: `self.ensure_one()`
 
+        :return: None
+        """
+        self.ensure_one()
+        if self.state not in ('draft', 'pending'):
+            self.ifthenpay_poll_next_date = False
+            return
+
+        try:
+            data = self._ifthenpay_fetch_status(self.ifthenpay_txid)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            _logger.error("Erro na requisicao ao ifthenpay: %s", e)
+            data = None
+
+        if not isinstance(data, dict):
+            self._ifthenpay_postpone_status_poll()
+            return
+
+        self.ifthenpay_poll_next_date = False
+        if not self._ifthenpay_match_gateway_status(data):
+            return
+        if data.get('PaymentMethod') in const.STATUS_POLL_PAYMENT_METHODS:
+            self.env['payment.transaction']._handle_notification_data('ifthenpay', {
+                'reference': self.reference,
+                'amount': self.amount,
+                'txid': self.ifthenpay_txid,
+                'apk': self.provider_id.ifthenpay_api_key,
+            })
+
+    def _ifthenpay_postpone_status_poll(self):
+        """ Schedule the next status lookup of the transaction with a backoff, or give up.
+
+        Note: `self.ensure_one()`
+
+        :return: None
+        """
+        self.ensure_one()
+        attempts = self.ifthenpay_poll_attempts + 1
+        if attempts >= const.STATUS_POLL_MAX_ATTEMPTS:
+            _logger.info("ifthenpay: giving up the status lookup of transaction %s.", self.reference)
+            self.write({'ifthenpay_poll_attempts': attempts, 'ifthenpay_poll_next_date': False})
+            return
+        delay = min(const.STATUS_POLL_BASE_DELAY * 2 ** attempts, const.STATUS_POLL_MAX_DELAY)
+        self.write({
+            'ifthenpay_poll_attempts': attempts,
+            'ifthenpay_poll_next_date': fields.Datetime.now() + timedelta(seconds=delay),
+        })
+
+    @api.model
+    def _cron_ifthenpay_poll_status(self, limit=100):
+        """ Fetch the gateway status of the transactions whose lookup is due.
+
+        :param int limit: The maximum number of transactions processed per run.
+        :return: None
+        """
+        txs = self.sudo().search([
+            ('ifthenpay_poll_next_date', '<=', fields.Datetime.now()),
+        ], order='ifthenpay_poll_next_date', limit=limit)
+        unrecorded_failure = False
+        for tx in txs:
+            try:
+                tx._ifthenpay_poll_status()
+            except Exception as e:
+                if isinstance(e, psycopg2.OperationalError):
+                    _logger.info("ifthenpay: status lookup of transaction %s postponed: %s", tx.reference, e)
+                else:
+                    _logger.exception("ifthenpay: status lookup of transaction %s failed: %s", tx.reference, e)
+                self.env.cr.rollback()
+                # the failed attempt counts, otherwise the transaction stays due and the cron loops on it
+                try:
+                    tx._ifthenpay_postpone_status_poll()
+                except psycopg2.OperationalError:
+                    self.env.cr.rollback()
+                    unrecorded_failure = True
+                    continue
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
+
+        next_tx = self.sudo().search([
+            ('ifthenpay_poll_next_date', '!=', False),
+        ], order='ifthenpay_poll_next_date', limit=1)
+        if next_tx:
+            at = max(next_tx.ifthenpay_poll_next_date, fields.Datetime.now())
+            if unrecorded_failure:
+                # a transaction is still due after failing, do not run again right away
+                at = max(at, fields.Datetime.now() + timedelta(seconds=const.STATUS_POLL_MAX_DELAY))
+            self.env.ref('payment_ifthenpay_oficial.cron_ifthenpay_poll_status')._trigger(at=at)
+
+    @api.model
+    def _ifthenpay_map_gateway_status(self, data):
+        """ Return the state matching the status data of a gateway transaction.
+
+        :param dict data: The status data returned by ifthenpay.
+        :return: The state, as a key of `const.PAYMENT_STATUS_MAPPING`, or None if unknown.
+        :rtype: str
+        """
+        status = str(data.get('Status') or data.get('status') or '').upper()
+        for state, statuses in const.PAYMENT_STATUS_MAPPING.items():
+            if status in statuses:
+                return state
+        if not status and data.get('PaymentMethod') in const.STATUS_POLL_PAYMENT_METHODS:
+            return 'done'
         return None
+
+    @api.model
+    def _cron_ifthenpay_reconcile(self):
+        """ Reconcile the open ifthenpay transactions with their status at the gateway.
+
+        The transactions are processed in batches, each committed on its own. The gateway is queried
+        concurrently within a batch, and the run stops after its time budget and schedules itself
+        again.
+
+        :return: None
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        batch_size = int(ICP.get_param('payment_ifthenpay_oficial.reconcile_batch_size', 500))
+        max_workers = int(ICP.get_param('payment_ifthenpay_oficial.reconcile_workers', 8))
+        time_budget = int(ICP.get_param('payment_ifthenpay_oficial.reconcile_time_budget', 600))
+        deadline = time.monotonic() + time_budget
+
+        last_id = 0
+        while True:
+            txs = self.sudo().search([
+                ('id', '>', last_id),
+                ('provider_code', '=', 'ifthenpay'),
+                ('state', 'in', ('draft', 'pending')),
+                ('ifthenpay_txid', '!=', False),
+            ], order='id', limit=batch_size)
+            if not txs:
+                break
+            last_id = txs[-1].id
+
+            try:
+                txs._ifthenpay_reconcile(max_workers)
+                if not self.env.registry.in_test_mode():
+                    self.env.cr.commit()
+            except psycopg2.OperationalError as e:
+                _logger.info("ifthenpay: reconciliation of a batch postponed: %s", e)
+                self.env.cr.rollback()
+            except Exception as e:
+                # one failing batch must not block the batches after it
+                _logger.exception("ifthenpay: reconciliation of the batch ending at transaction %s failed: %s", last_id, e)
+                self.env.cr.rollback()
+
+            if time.monotonic() > deadline:
+                self.env.ref('payment_ifthenpay_oficial.cron_ifthenpay_reconcile')._trigger()
+                break
+
+    def _ifthenpay_reconcile(self, max_workers):
+        """ Fetch the gateway status of the transactions concurrently and apply the changes in bulk.
+
+        :param int max_workers: The maximum number of concurrent requests.
+        :return: None
+        """
+        Circuit = self.env['payment.ifthenpay.circuit'].sudo()
+        if not Circuit._allow('status'):
+            _logger.info("ifthenpay: reconciliation skipped, the status endpoint is unavailable.")
+            return
+        results = client.request_many([
+            tx.provider_id._ifthenpay_prepare_request('status', params={'transactionId': tx.ifthenpay_txid})
+            for tx in self
+        ], max_workers)
+        if results:
+            Circuit._record('status', success=not all(client.is_failure(result) for result in results))
+        self.env['payment.ifthenpay.metric']._flush()
+
+        txs_by_state = defaultdict(lambda: self.browse())
+        for tx, result in zip(self, results):
+            if isinstance(result, Exception) or result.status_code != 200:
+                continue
+            try:
+                data = result.json()
+            except ValueError:
+                continue
+            if not isinstance(data, dict) or not tx._ifthenpay_match_gateway_status(data):
+                continue
+            state = self._ifthenpay_map_gateway_status(data)
+            if state and state != tx.state:
+                txs_by_state[state] |= tx
+        self._ifthenpay_apply_gateway_states(txs_by_state)
+
+    @api.model
+    def _ifthenpay_apply_gateway_states(self, txs_by_state):
+        """ Move the transactions to the states reported by the gateway, one write per state.
+
+        :param dict txs_by_state: The transactions to update, by target state.
+        :return: None
+        """
+        txs = self.browse().union(*txs_by_state.values())
+        if not txs:
+            return
+        self.env.cr.execute(
+            "SELECT id FROM payment_transaction WHERE id IN %s FOR NO KEY UPDATE", [tuple(txs.ids)]
+        )
+        txs.invalidate_recordset(['state', 'payment_id'])
+
+        def is_open(tx):
+            return tx.state in ('draft', 'pending')
+
+        done_txs = txs_by_state.get('done', self.browse()).filtered(is_open)
+        for tx in done_txs:
+            tx.provider_reference = f"ifthenpay_{tx.reference}"
+        done_txs._set_done()
+        for tx in done_txs.filtered(lambda tx: 'inv' in tx.reference.lower() and not tx.payment_id):
+            tx._create_payment()
+
+        txs_by_state.get('pending', self.browse()).filtered(lambda tx: tx.state == 'draft')._set_pending()
+        txs_by_state.get('cancel', self.browse()).filtered(is_open)._set_canceled()
+        txs_by_state.get('error', self.browse()).filtered(is_open)._set_error(
+            _("The payment was refused by ifthenpay.")
+        )
+
+        for tx in txs:
+            tx._ifthenpay_notify_status()
+
+    @api.model
+    def _cron_ifthenpay_cancel_expired(self):
+        """ Cancel the open ifthenpay transactions whose payment link has expired.
+
+        The transactions are found through the index on `ifthenpay_expiry_date` and canceled in
+        chunks with a single write each, committed one by one so that no lock is held for long. A
+        grace period, in hours, leaves time for the callbacks of the payments made just before the
+        expiry to arrive, since a canceled transaction cannot be confirmed anymore.
+
+        :return: None
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        batch_size = int(ICP.get_param('payment_ifthenpay_oficial.expiry_batch_size', 1000))
+        grace_hours = float(ICP.get_param('payment_ifthenpay_oficial.expiry_grace_hours', 24))
+        limit_date = fields.Datetime.now() - timedelta(hours=grace_hours)
+        while True:
+            txs = self.sudo().search([
+                ('ifthenpay_expiry_date', '<', limit_date),
+                ('state', 'in', ('draft', 'pending')),
+            ], limit=batch_size)
+            if not txs:
+                break
+            txs._set_canceled(state_message=_("The ifthenpay payment link has expired."))
+            _logger.info("ifthenpay: %s expired transactions canceled.", len(txs))
+            if self.env.registry.in_test_mode():
+                break
+            self.env.cr.commit()
+
+    @api.model
+    def _ifthenpay_export_csv(self, date_from=None, date_to=None, states=None, payment_methods=None):
+        """ Return the ifthenpay transactions of the current companies as a stream of CSV chunks.
+
+        The rows are read through a server-side cursor of a dedicated read-only transaction and
+        written out one chunk at a time, so that the memory used stays the same whatever the number
+        of transactions. The stream may thus be consumed after the current request is over.
+
+        :param date date_from: The first creation date of the transactions to export, if any.
+        :param date date_to: The last creation date of the transactions to export, if any.
+        :param list states: The states of the transactions to export, if any.
+        :param recordset payment_methods: The `payment.method` of the transactions to export, if any.
+        :return: The CSV file, UTF-8 encoded, in chunks.
+        :rtype: iterator of bytes
+        """
+        chunk_size = int(self.env['ir.config_parameter'].sudo().get_param(
+            'payment_ifthenpay_oficial.export_batch_size', 2000
+        ))
+        conditions = ["provider.code = 'ifthenpay'", "tx.company_id IN %(company_ids)s"]
+        params = {'company_ids': tuple(self.env.companies.ids)}
+        if date_from:
+            conditions.append("tx.create_date >= %(date_from)s")
+            params['date_from'] = date_from
+        if date_to:
+            conditions.append("tx.create_date < %(date_to)s")
+            params['date_to'] = date_to + timedelta(days=1)
+        if states:
+            conditions.append("tx.state IN %(states)s")
+            params['states'] = tuple(states)
+        if payment_methods:
+            conditions.append("tx.payment_method_id IN %(payment_method_ids)s")
+            params['payment_method_ids'] = tuple(payment_methods.ids)
+        # ordered by id so that the rows are read from the primary key as they are sent
+        query = f"""
+            SELECT tx.reference, tx.provider_reference, tx.ifthenpay_txid, tx.state, tx.amount,
+                   currency.name, currency.decimal_places, tx.payment_method_id, tx.partner_name,
+                   tx.create_date, tx.last_state_change, tx.ifthenpay_pinpay_date, tx.ifthenpay_expiry_date
+              FROM payment_transaction tx
+              JOIN payment_provider provider ON provider.id = tx.provider_id
+              JOIN res_currency currency ON currency.id = tx.currency_id
+             WHERE {' AND '.join(conditions)}
+          ORDER BY tx.id
+        """
+
+        # the labels are resolved now, the stream runs without the environment of the request
+        state_labels = dict(self._fields['state']._description_selection(self.env))
+        method_names = {
+            method.id: method.name
+            for method in self.env['payment.method'].sudo().with_context(active_test=False).search([])
+        }
+        header = [
+            _("Reference"), _("Provider Reference"), _("ifthenpay Transaction ID"), _("Status"), _("Amount"),
+            _("Currency"), _("Payment Method"), _("Customer"), _("Created on"), _("Last Status Change"),
+            _("Payment Link Date"), _("Payment Link Expiry"), _("Seconds to Payment"),
+        ]
+        registry = self.env.registry
+
+        def format_datetime(value):
+            return value and fields.Datetime.to_string(value) or ''
+
+        def stream():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(header)
+            yield codecs.BOM_UTF8 + buffer.getvalue().encode()
+            with registry.cursor() as cr:
+                cr.execute("SET TRANSACTION READ ONLY")
+                with cr._cnx.cursor(name='payment_ifthenpay_export') as server_cursor:
+                    server_cursor.itersize = chunk_size
+                    server_cursor.execute(query, params)
+                    while rows := server_cursor.fetchmany(chunk_size):
+                        buffer.seek(0)
+                        buffer.truncate()
+                        for (
+                            reference, provider_reference, txid, state, amount, currency, decimal_places,
+                            method_id, partner_name, create_date, last_state_change, pinpay_date, expiry_date,
+                        ) in rows:
+                            writer.writerow([
+                                reference,
+                                provider_reference or '',
+                                txid or '',
+                                state_labels.get(state, state),
+                                float_repr(amount, decimal_places),
+                                currency,
+                                method_names.get(method_id, ''),
+                                partner_name or '',
+                                format_datetime(create_date),
+                                format_datetime(last_state_change),
+                                format_datetime(pinpay_date),
+                                format_datetime(expiry_date),
+                                int((last_state_change - create_date).total_seconds())
+                                if state == 'done' and last_state_change and create_date else '',
+                            ])
+                        yield buffer.getvalue().encode()
+
+        return stream()
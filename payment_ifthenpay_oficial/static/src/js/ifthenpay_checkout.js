@@ -2,9 +2,13 @@
 
 import publicWidget from '@web/legacy/js/public/public_widget';
 import { _t } from '@web/core/l10n/translation';
-import { rpc } from '@web/core/network/rpc';
 import { notificationService } from '@web/core/notifications/notification_service';
 
+const METHODS_STORAGE_KEY = 'ifthenpay_payment_methods';
+const METHODS_STORAGE_TTL = 10 * 60 * 1000;
+// Longest wait, in seconds, before retrying a request refused by the rate limiter.
+const RATE_LIMIT_MAX_WAIT = 10;
+
 const IfThenPayCheckoutWidget = publicWidget.Widget.extend({
     services: [
         'notification',
@@ -86,6 +90,52 @@ const IfThenPayCheckoutWidget = publicWidget.Widget.extend({
         }
     },
 
+    /**
+     * Return the payment methods, from the copy kept in the session storage while it is fresh.
+     * Otherwise the endpoint is requested with a plain GET so that the browser cache and the
+     * reverse proxy can answer it through its ETag, and retried once if it is rate limited.
+     *
+     * @private
+     * @return {Object} The response of the endpoint.
+     */
+    _loadPaymentMethods: async function () {
+        try {
+            const stored = JSON.parse(sessionStorage.getItem(METHODS_STORAGE_KEY));
+            if (stored && Date.now() - stored.time < METHODS_STORAGE_TTL) {
+                return stored.result;
+            }
+        } catch {
+            // ignore a corrupted or unavailable storage
+        }
+        const request = () => fetch('/payment/ifthenpay/get_payment_methods_icons', {
+            headers: { 'Accept': 'application/json' },
+        });
+        let response = await request();
+        if (response.status === 429) {
+            // too many requests from this visitor: wait as told by the server, then try once more
+            const wait = Math.min(parseInt(response.headers.get('Retry-After')) || 1, RATE_LIMIT_MAX_WAIT);
+            await new Promise((resolve) => setTimeout(resolve, wait * 1000));
+            response = await request();
+        }
+        const result = await response.json();
+        if (!result.error) {
+            this._storePaymentMethods(result);
+        }
+        return result;
+    },
+
+    /**
+     * @private
+     * @param {Object} result The successful response of the endpoint.
+     */
+    _storePaymentMethods: function (result) {
+        try {
+            sessionStorage.setItem(METHODS_STORAGE_KEY, JSON.stringify({ time: Date.now(), result: result }));
+        } catch {
+            // the storage may be full or disabled
+        }
+    },
+
     /**
      * Busca os ícones de pagamento do backend e os exibe no container fornecido.
      * @param {jQuery} targetContainer O elemento jQuery onde os icones devem ser injetados.
@@ -97,9 +147,7 @@ const IfThenPayCheckoutWidget = publicWidget.Widget.extend({
         }
 
         try {
-            const result = await rpc('/payment/ifthenpay/get_payment_methods_icons', { 
-                params: {},
-            });
+            const result = await this._loadPaymentMethods();
 
             if (result.error) {
                 console.error('ifthenpay API Error from Backend:', result.error);
@@ -121,7 +169,7 @@ const IfThenPayCheckoutWidget = publicWidget.Widget.extend({
             targetContainer.empty();
             data.forEach(method => {
                 const img = $('<img>', {
-                    src: method.SmallImageUrl,
+                    src: method.ImageData || method.LocalImageUrl || method.SmallImageUrl,
                     alt: method.Method,
                     style: 'height: 30px; margin-right: 6px;',
                 });
@@ -0,0 +1,98 @@
+/** @odoo-module **/
+
+import paymentForm from '@payment/js/payment_form';
+import { loadBundle } from '@web/core/assets';
+
+// The bundle holding the checkout flow of ifthenpay: the modal, its styles and its logic.
+const CHECKOUT_BUNDLE = 'payment_ifthenpay_oficial.assets_checkout';
+
+paymentForm.include({
+    _ifthenpayLoading: null,
+    _ifthenpayReady: false,
+
+    /**
+     * @override
+     * Load the checkout flow of ifthenpay only once it is selected.
+     */
+    start: async function () {
+        const _superResult = await this._super.apply(this, arguments);
+
+        const preload = (radio) => this._ifthenpayLoad(radio).catch((error) => {
+            // loaded again when "Pay" is clicked
+            console.warn("ifthenpay: could not load the checkout:", error);
+        });
+        this.el.addEventListener('change', (ev) => {
+            if (ev.target.name === 'o_payment_radio' && ev.target.dataset.providerCode === 'ifthenpay') {
+                preload(ev.target);
+            }
+        });
+        const checkedRadio = this.el.querySelector('input[name="o_payment_radio"]:checked');
+        if (checkedRadio && checkedRadio.dataset.providerCode === 'ifthenpay') {
+            preload(checkedRadio);
+        }
+
+        return _superResult;
+    },
+
+    /**
+     * @override
+     * Wait for the checkout flow of ifthenpay if "Pay" is clicked before it is loaded.
+     */
+    _processRedirectFlow: async function (providerCode) {
+        if (providerCode !== 'ifthenpay' || this._ifthenpayReady) {
+            return this._super(...arguments);
+        }
+        await this._ifthenpayLoad(this.el.querySelector('input[name="o_payment_radio"]:checked'));
+        // dispatch again, to the override of the bundle that was just loaded
+        return this._processRedirectFlow(...arguments);
+    },
+
+    /**
+     * Hint the browser to connect to the gateway, then load and set up the checkout bundle.
+     *
+     * @private
+     * @param {HTMLInputElement} radio The radio input of the ifthenpay payment option.
+     * @return {Promise} Resolved once the checkout flow is ready.
+     */
+    _ifthenpayLoad: function (radio) {
+        if (!this._ifthenpayLoading) {
+            this._ifthenpayAddResourceHints(radio);
+            this._ifthenpayLoading = loadBundle(CHECKOUT_BUNDLE).then(() => {
+                this._ifthenpaySetup();
+                this._ifthenpayReady = true;
+            }).catch((error) => {
+                // let the next selection or "Pay" try again
+                this._ifthenpayLoading = null;
+                throw error;
+            });
+        }
+        return this._ifthenpayLoading;
+    },
+
+    /**
+     * Add preconnect and dns-prefetch hints for the origins of the gateway and of the icons.
+     *
+     * @private
+     * @param {HTMLInputElement} radio The radio input of the ifthenpay payment option.
+     */
+    _ifthenpayAddResourceHints: function (radio) {
+        let origins = [];
+        try {
+            origins = JSON.parse(radio?.dataset.ifthenpayInlineFormValues || '{}').preconnect_origins || [];
+        } catch {
+            return;
+        }
+        for (const origin of origins) {
+            for (const rel of ['preconnect', 'dns-prefetch']) {
+                if (document.head.querySelector(`link[rel="${rel}"][href="${origin}"]`)) {
+                    continue;
+                }
+                // no crossorigin: the iframe and the icons are fetched in no-cors mode
+                const link = document.createElement('link');
+                link.rel = rel;
+                link.href = origin;
+                document.head.appendChild(link);
+            }
+        }
+    },
+});
@@ -4,30 +4,31 @@ import { rpc, RPCError } from "@web/core/network/rpc";
 import paymentForm from '@payment/js/payment_form';
 import { _t } from "@web/core/l10n/translation";
 import { ConfirmationDialog } from '@web/core/confirmation_dialog/confirmation_dialog';
+import { renderToElement } from '@web/core/utils/render';
+
+// Longest wait, in seconds, before retrying a status check refused by the rate limiter.
+const RATE_LIMIT_MAX_WAIT = 10;
 
 paymentForm.include({
     _ifthenpayModal: null,
     _ifthenpayIframe: null,
     _ifthenpayLoadingModal: null,
-    _isIfthenpaySelected: false,
     _currentIfthenpayTxRef: null,
+    _ifthenpayBusService: null,
+    _ifthenpayBusChannel: null,
 
     /**
-     * @override
-     * Inicializa o widget e configura os listeners para o modal e iframe.
+     * Render the modal and bind its listeners. Called by the loader once this bundle is loaded,
+     * when ifthenpay is selected for the first time.
      */
-    start: async function () {
-        const _superResult = await this._super.apply(this, arguments);
-
+    _ifthenpaySetup: function () {
+        if (!document.querySelector('#ifthenpay_modal')) {
+            document.body.appendChild(renderToElement('payment_ifthenpay_oficial.CheckoutModal'));
+        }
         this._ifthenpayModal = document.querySelector('#ifthenpay_modal');
         this._ifthenpayIframe = document.querySelector('#ifthenpay_iframe');
         this._ifthenpayLoadingModal = document.querySelector('#ifthenpay_loading_modal');
 
-        if (!this._ifthenpayModal || !this._ifthenpayIframe || !this._ifthenpayLoadingModal) {
-            console.error("ifthenpay: CRITICO! Elementos do modal NAO encontrados. Verifique se o template 'ifthenpay_checkout_modal' esta carregado globalmente no HTML.");
-            return _superResult;
-        }
-
         this._ifthenpayModal = $(this._ifthenpayModal).modal({ show: false, backdrop: 'static', keyboard: false });
 
         this._ifthenpayIframe.style.display = 'none';
@@ -41,9 +42,7 @@ paymentForm.include({
             this._enableButton(true); 
             if (this._currentIfthenpayTxRef) {
                 try {
-                    const statusCheckResponse = await rpc('/payment/ifthenpay/check_transaction_status', {
-                        tx_reference: this._currentIfthenpayTxRef,
-                    });
+                    const statusCheckResponse = await this._checkIfthenpayStatus(this._currentIfthenpayTxRef);
 
                     if (statusCheckResponse && (statusCheckResponse.status === 'success' || statusCheckResponse.status === 'pending')) {
                         window.location.href = '/shop/payment/validate';
@@ -56,6 +55,7 @@ paymentForm.include({
                     console.error("ifthenpay: Erro ao verificar status da transacao apos fechar modal:", error);
                 } finally {
                     this._currentIfthenpayTxRef = null;
+                    this._leaveIfthenpayBusChannel();
                 }
             }
         });
@@ -69,15 +69,10 @@ paymentForm.include({
         });
 
         window.addEventListener('message', this._onIframeMessage.bind(this), false);
-        
-        this.el.addEventListener('change', (ev) => {
-            if (ev.target.name === 'o_payment_radio') {
-                const selectedProviderCode = ev.target.dataset.providerCode;
-                this._isIfthenpaySelected = (selectedProviderCode === 'ifthenpay');
-            }
-        });
 
-        return _superResult;
+        // the status of the transaction is pushed as soon as the callback of ifthenpay is processed
+        this._ifthenpayBusService = this.bindService('bus_service');
+        this._ifthenpayBusService.subscribe('ifthenpay_tx_status', this._onIfthenpayStatusNotification.bind(this));
     },
 
     /**
@@ -126,11 +121,23 @@ paymentForm.include({
                 payment_method_code: paymentMethodCode,
             });
 
+            if (response.rate_limited) {
+                this._ifthenpayModal.modal('hide');
+                this._displayErrorDialog(_t("Too Many Attempts"), response.error);
+                this._enableButton(true);
+                this._currentIfthenpayTxRef = null;
+                return;
+            }
+
             if (response.error) {
                 throw new Error(response.error);
             }
 
             if (response.redirect_url) {
+                if (response.bus_channel) {
+                    this._ifthenpayBusChannel = response.bus_channel;
+                    this._ifthenpayBusService.addChannel(response.bus_channel);
+                }
                 this._ifthenpayIframe.src = response.redirect_url;
             } else if (response.status) {
                 this._ifthenpayModal.modal('hide');
@@ -155,48 +162,81 @@ paymentForm.include({
     },
 
     /**
+     * Fetch the status of the transaction, retrying once if the server asks to slow down.
+     *
      * @private
+     * @param {string} reference The reference of the transaction.
+     * @return {Object} The status of the transaction.
      */
-    _onIframeMessage: function (event) {
-        if (event.data && typeof event.data === 'object') {
-            if (event.data.type === 'ifthenpay_loading_ready') {
-                const params = event.data.params;
-                const queryString = new URLSearchParams(params).toString();
-                
-                fetch(`/payment/ifthenpay/iframe_callback?${queryString}`)
-                .then(result => {
-                    this._ifthenpayModal.modal('hide');
-                }).catch(error => {
-                    this._ifthenpayModal.modal('hide');
-                    this._displayErrorDialog(_t("Payment Failed"), _t("The payment with ifthenpay failed. Please try again."));
-                    this._currentIfthenpayTxRef = null;
-                });
+    _checkIfthenpayStatus: async function (reference) {
+        let response = await rpc('/payment/ifthenpay/check_transaction_status', { tx_reference: reference });
+        if (response && response.rate_limited) {
+            const wait = Math.min(response.retry_after || 1, RATE_LIMIT_MAX_WAIT);
+            await new Promise((resolve) => setTimeout(resolve, wait * 1000));
+            response = await rpc('/payment/ifthenpay/check_transaction_status', { tx_reference: reference });
+        }
+        return response;
+    },
 
-            } else if (event.data.type === 'ifthenpay_payment_status') {
-                const status = event.data.status;
-                const message = event.data.message;
+    /**
+     * @private
+     * @param {Object} payload The status of the transaction, published by the server.
+     */
+    _onIfthenpayStatusNotification: function (payload) {
+        if (!payload || !this._currentIfthenpayTxRef || payload.reference !== this._currentIfthenpayTxRef) {
+            return;
+        }
+        if (payload.status !== 'success' && payload.status !== 'pending' && payload.status !== 'error') {
+            return;
+        }
+        this._currentIfthenpayTxRef = null;
+        this._leaveIfthenpayBusChannel();
+        this._ifthenpayModal.modal('hide');
+        if (payload.status === 'error') {
+            this._displayErrorDialog(_t("Payment Failed"), payload.message || _t("The payment was not completed successfully."));
+        } else {
+            window.location.href = '/shop/payment/validate';
+        }
+    },
 
-                if (status === 'success') {
-                    this._ifthenpayModal.modal('hide');
-                    window.location.href = '/shop/payment/validate';
-                    this._currentIfthenpayTxRef = null;
-                } else if (status === 'failed') {
-                    this._ifthenpayModal.modal('hide');
-                    this._displayErrorDialog(_t("Payment Failed"), message || _t("The payment with ifthenpay failed. Please try again."));
-                    this._currentIfthenpayTxRef = null;
-                } else if (status === 'pending') {
-                    this._ifthenpayModal.modal('hide');
-                    window.location.href = '/shop/payment/validate';
-                    this._currentIfthenpayTxRef = null;
-                } else if (status === 'closed') {
-                    this._ifthenpayModal.modal('hide');
-                    this._displayErrorDialog(_t("Payment Cancelled"), message || _t("The payment has been canceled. Please try again."));
-                    this._currentIfthenpayTxRef = null;
-                }
-            }
+    /**
+     * @private
+     */
+    _leaveIfthenpayBusChannel: function () {
+        if (this._ifthenpayBusChannel) {
+            this._ifthenpayBusService.deleteChannel(this._ifthenpayBusChannel);
+            this._ifthenpayBusChannel = null;
         }
     },
 
+    /**
+     * @private
+     */
+    _onIframeMessage: function (event) {
+        if (event.origin !== window.location.origin || !event.data || event.data.type !== 'ifthenpay_loading_ready') {
+            return;
+        }
+        const queryString = new URLSearchParams(event.data.params).toString();
+
+        fetch(`/payment/ifthenpay/iframe_callback?${queryString}`)
+        .then(response => response.json())
+        .then(result => {
+            // the result is final here, so the modal is closed without checking the status again
+            this._currentIfthenpayTxRef = null;
+            this._leaveIfthenpayBusChannel();
+            this._ifthenpayModal.modal('hide');
+            if (result.status === 'failed') {
+                this._displayErrorDialog(_t("Payment Failed"), result.message || _t("The payment with ifthenpay failed. Please try again."));
+            } else {
+                window.location.href = '/shop/payment/validate';
+            }
+        }).catch(error => {
+            this._ifthenpayModal.modal('hide');
+            this._displayErrorDialog(_t("Payment Failed"), _t("The payment with ifthenpay failed. Please try again."));
+            this._currentIfthenpayTxRef = null;
+        });
+    },
+
     /**
      * @private
      */
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import json
+from unittest.mock import patch
+
+import requests
+
+from odoo.tests import tagged
+
+from odoo.addons.payment.tests.http_common import PaymentHttpCommon
+from odoo.addons.payment_ifthenpay_oficial import client
+
+API_KEY = 'TEST-API-KEY'
+GATEWAY_URL = 'https://gateway.ifthenpay.test'
+
+
+@tagged('post_install', '-at_install')
+class TestQueryCount(PaymentHttpCommon):
+    """ Fix the number of SQL queries of the checkout, callback and status routes.
+
+    Each route is called once to fill the caches, then measured on a new transaction. The budgets
+    are upper bounds: a change that makes a route more expensive must update them knowingly.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.provider = cls._prepare_provider('ifthenpay', update_values={
+            'state': 'enabled',
+            'ifthenpay_api_key': API_KEY,
+            'ifthenpay_gateway_key': 'TEST-GATEWAY-KEY',
+        })
+        cls.payment_method_id = cls.env.ref('payment_ifthenpay_oficial.payment_method_ifthenpay_provider').id
+        cls.currency = cls.currency_euro
+
+    def _create_ifthenpay_transaction(self, reference):
+        return self._create_transaction(
+            'redirect', reference=reference, payment_method_id=self.payment_method_id,
+        )
+
+    def _mock_api(self):
+        """ Answer the calls to the ifthenpay API without reaching the network. """
+        def request(endpoint, method, url, timeout, **kwargs):
+            if endpoint == 'integration':
+                payload = {
+                    'gatewayKey': 'TEST-GATEWAY-KEY',
+                    'expiryDays': '1',
+                    'storeUrl': self.base_url(),
+                    'accountKeys': 'MB|1234;MBWAY|5678',
+                    'paymentData': '{}',
+                }
+            elif endpoint == 'pinpay':
+                payload = {'PinCode': '1234', 'PinpayUrl': f"{GATEWAY_URL}/pay/{kwargs['json']['id']}"}
+            else:
+                payload = {}
+            response = requests.Response()
+            response.status_code = 200
+            response._content = json.dumps(payload).encode()
+            response.headers['Content-Type'] = 'application/json'
+            return response
+        return patch.object(client, 'request', side_effect=request)
+
+    def _submit_payment(self, tx):
+        response = self._make_json_rpc_request(self._build_url('/payment/ifthenpay/submit_payment'), {
+            'provider_id': self.provider.id,
+            'tx_reference': tx.reference,
+        })
+        self.assertEqual(response.status_code, 200)
+        result = response.json()['result']
+        self.assertTrue(result.get('redirect_url'), result)
+
+    def _s2s_callback(self, tx):
+        response = self._make_http_get_request(self._build_url('/payment/ifthenpay/s2s_callback'), {
+            'apk': API_KEY,
+            'reference': tx.reference,
+            'amount': tx.amount,
+            'txid': f'TX-{tx.reference}',
+        })
+        self.assertEqual(response.status_code, 200)
+
+    def _iframe_callback(self, tx):
+        response = self._make_http_get_request(self._build_url('/payment/ifthenpay/iframe_callback'), {
+            'reference': tx.reference,
+            'amount': tx.amount,
+            'status': 'success',
+            'txid': f'TX-{tx.reference}',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'pending')
+
+    def _check_transaction_status(self, tx):
+        response = self._make_json_rpc_request(
+            self._build_url('/payment/ifthenpay/check_transaction_status'), {'tx_reference': tx.reference},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('status', response.json()['result'])
+
+    def test_submit_payment_query_count(self):
+        warmup_tx = self._create_ifthenpay_transaction('IFTHENPAY-QC-1')
+        tx = self._create_ifthenpay_transaction('IFTHENPAY-QC-2')
+        with self._mock_api():
+            self._submit_payment(warmup_tx)
+            with self.assertQueryCount(45):
+                self._submit_payment(tx)
+
+    def test_s2s_callback_query_count(self):
+        warmup_tx = self._create_ifthenpay_transaction('IFTHENPAY-QC-1')
+        tx = self._create_ifthenpay_transaction('IFTHENPAY-QC-2')
+        with self._mock_api():
+            self._s2s_callback(warmup_tx)
+            with self.assertQueryCount(25):
+                self._s2s_callback(tx)
+
+    def test_iframe_callback_query_count(self):
+        warmup_tx = self._create_ifthenpay_transaction('IFTHENPAY-QC-1')
+        tx = self._create_ifthenpay_transaction('IFTHENPAY-QC-2')
+        with self._mock_api():
+            self._iframe_callback(warmup_tx)
+            with self.assertQueryCount(35):
+                self._iframe_callback(tx)
+
+    def test_check_transaction_status_query_count(self):
+        warmup_tx = self._create_ifthenpay_transaction('IFTHENPAY-QC-1')
+        tx = self._create_ifthenpay_transaction('IFTHENPAY-QC-2')
+        with self._mock_api():
+            self._check_transaction_status(warmup_tx)
+            with self.assertQueryCount(20):
+                self._check_transaction_status(tx)
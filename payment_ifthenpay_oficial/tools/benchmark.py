@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Benchmark of the ifthenpay checkout and callback routes, against the local simulator.
+
+The benchmark creates draft transactions through XML-RPC and measures, with `--concurrency`
+clients:
+
+- `submit_payment`: the creation of the Pinpay payments;
+- `iframe_callback`: the customer's return from the gateway, then the time until the status
+  polling confirms the payment (`confirm` in the results);
+- `s2s_callback`: the callbacks of ifthenpay;
+- `get_payment_methods_icons`: the list of payment methods of the checkout.
+
+Each scenario reports its p50/p95/p99 latency in milliseconds, its requests per second and, from
+the metrics route of the module, the SQL queries per request. The resident memory of the Odoo
+processes found on this machine is reported as well.
+
+Usage, on a throwaway database with the module installed::
+
+    IFTHENPAY_METRICS_FLUSH_INTERVAL=0 odoo-bin -d bench --workers=4 ...
+    python3 benchmark.py --url http://localhost:8069 --db bench --setup --requests 200 \\
+        --output results.json --baseline baseline.json
+
+`--setup` points the ifthenpay provider to the simulator started by the benchmark and sets the
+token of the metrics route; it must never be used on a production database. The rate limits of the
+provider are disabled while the benchmark runs, since all its requests come from one address, and
+restored afterwards. The process exits
+with status 1 when a scenario is slower, runs more queries or uses more memory than the baseline
+by more than `--tolerance`. `--save-baseline` stores the results as the new baseline.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+import simulator
+
+# Metrics compared with the baseline: (scenario metric, whether higher is better).
+COMPARED_METRICS = (
+    ('p95_ms', False),
+    ('rps', True),
+    ('queries_per_request', False),
+)
+
+METRICS_TOKEN = 'benchmark'
+
+RATE_LIMIT_FIELDS = ['ifthenpay_rate_limit_ip', 'ifthenpay_rate_limit_session']
+
+
+class Odoo:
+    """ The Odoo server under benchmark. """
+
+    def __init__(self, url, db, login, password):
+        self.url = url.rstrip('/')
+        self.db = db
+        self.password = password
+        self.uid = xmlrpc.client.ServerProxy(self.url + '/xmlrpc/2/common').authenticate(db, login, password, {})
+        if not self.uid:
+            sys.exit("Authentication failed for %s on %s" % (login, db))
+        self.local = threading.local()
+
+    def call(self, model, method, *args, **kwargs):
+        if not hasattr(self.local, 'proxy'):
+            self.local.proxy = xmlrpc.client.ServerProxy(self.url + '/xmlrpc/2/object', allow_none=True)
+        return self.local.proxy.execute_kw(self.db, self.uid, self.password, model, method, list(args), kwargs)
+
+    def get(self, path, params=None):
+        return self._send(Request(self.url + path + ('?' + urlencode(params) if params else '')))
+
+    def json_rpc(self, path, params):
+        data = json.dumps({'jsonrpc': '2.0', 'method': 'call', 'params': params}).encode()
+        status, body = self._send(Request(self.url + path, data=data, headers={'Content-Type': 'application/json'}))
+        result = json.loads(body).get('result') if status == 200 else None
+        if not isinstance(result, dict) or result.get('error'):
+            raise RuntimeError("%s failed: %s" % (path, body[:200]))
+        return result
+
+    def _send(self, request):
+        try:
+            with urlopen(request, timeout=120) as response:
+                return response.status, response.read()
+        except HTTPError as e:
+            return e.code, e.read()
+
+
+def setup(odoo, simulator_url, api_key):
+    """ Enable the ifthenpay provider on the simulator and set the token of the metrics route. """
+    provider_id = odoo.call('payment.provider', 'search', [('code', '=', 'ifthenpay')], limit=1)[0]
+    odoo.call('payment.provider', 'write', [provider_id], {
+        'state': 'enabled',
+        'ifthenpay_api_url': simulator_url,
+        'ifthenpay_api_key': api_key,
+    })
+    odoo.call('ir.config_parameter', 'set_param', 'payment_ifthenpay_oficial.metrics_token', METRICS_TOKEN)
+    return provider_id
+
+
+def setup_rate_limits(odoo, provider_id):
+    """ Disable the rate limits of the provider and return their previous values. """
+    previous = odoo.call('payment.provider', 'read', [provider_id], RATE_LIMIT_FIELDS)[0]
+    odoo.call('payment.provider', 'write', [provider_id], dict.fromkeys(RATE_LIMIT_FIELDS, 0))
+    return {field: previous[field] for field in RATE_LIMIT_FIELDS}
+
+
+def teardown_rate_limits(odoo, provider_id, previous):
+    """ Restore the rate limits of the provider. """
+    odoo.call('payment.provider', 'write', [provider_id], previous)
+
+
+def create_transactions(odoo, provider_id, count, prefix):
+    """ Create draft transactions and return their reference and amount. """
+    method_id = odoo.call('payment.method', 'search', [('code', '=', 'ifthenpay')], limit=1)[0]
+    currency_id = odoo.call('res.currency', 'search', [('name', '=', 'EUR')], limit=1)[0]
+    partner_id = odoo.call('res.users', 'read', [odoo.uid], ['partner_id'])[0]['partner_id'][0]
+    values = [{
+        'provider_id': provider_id,
+        'payment_method_id': method_id,
+        'currency_id': currency_id,
+        'partner_id': partner_id,
+        'amount': 10 + index % 90,
+        'reference': '%s-%s' % (prefix, index),
+    } for index in range(count)]
+    odoo.call('payment.transaction', 'create', values)
+    return [(value['reference'], '%.2f' % value['amount']) for value in values]
+
+
+def run(tasks, concurrency):
+    """ Run the tasks concurrently and return their duration in seconds, with the wall time.
+
+    :param list tasks: Callables; a task raising an exception counts as an error.
+    :param int concurrency: The number of tasks in flight.
+    :return: The durations of the successful tasks, the number of errors and the wall time.
+    :rtype: tuple
+    """
+    def timed(task):
+        started = time.perf_counter()
+        try:
+            task()
+        except Exception as e:
+            return e
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, tasks))
+    wall = time.perf_counter() - started
+    durations = [result for result in results if isinstance(result, float)]
+    return durations, len(results) - len(durations), wall
+
+
+def percentile(values, rank):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(rank / 100 * len(values)) - 1))]
+
+
+def summarize(durations, errors, wall):
+    return {
+        'count': len(durations) + errors,
+        'errors': errors,
+        'rps': round(len(durations) / wall, 2) if wall else None,
+        **{
+            'p%s_ms' % rank: durations and round(percentile(durations, rank) * 1000, 2)
+            for rank in (50, 95, 99)
+        },
+    }
+
+
+def scrape(odoo):
+    """ Return the sum and count of the SQL queries of each route, from the metrics route. """
+    status, body = odoo.get('/payment/ifthenpay/metrics', {'token': METRICS_TOKEN})
+    if status != 200:
+        return {}
+    totals = {}
+    pattern = re.compile(r'^ifthenpay_route_sql_queries_(sum|count)\{route="([^"]+)",result="[^"]*"\} (\S+)$')
+    for line in body.decode().splitlines():
+        match = pattern.match(line)
+        if match:
+            kind, route, value = match.groups()
+            total = totals.setdefault(route, {'sum': 0.0, 'count': 0.0})
+            total[kind] += float(value)
+    return totals
+
+
+def queries_per_request(before, after, route):
+    count = after.get(route, {}).get('count', 0) - before.get(route, {}).get('count', 0)
+    if not count:
+        return None
+    return round((after[route]['sum'] - before.get(route, {}).get('sum', 0)) / count, 2)
+
+
+def worker_memory():
+    """ Return the resident memory of the Odoo processes of this machine, in MiB (Linux only). """
+    sizes = []
+    for pid in filter(str.isdigit, os.listdir('/proc') if os.path.isdir('/proc') else ()):
+        if int(pid) == os.getpid():
+            continue
+        try:
+            with open('/proc/%s/cmdline' % pid, 'rb') as f:
+                if b'odoo' not in f.read():
+                    continue
+            with open('/proc/%s/status' % pid) as f:
+                rss = next(line for line in f if line.startswith('VmRSS:'))
+        except (OSError, StopIteration):
+            continue
+        sizes.append(int(rss.split()[1]) / 1024)
+    if not sizes:
+        return {}
+    return {
+        'processes': len(sizes),
+        'rss_mean_mb': round(sum(sizes) / len(sizes), 1),
+        'rss_max_mb': round(max(sizes), 1),
+    }
+
+
+def benchmark(odoo, sim, provider_id, api_key, count, concurrency, confirm_timeout):
+    results = {}
+    prefix = 'BENCH-%s' % uuid.uuid4().hex[:6].upper()
+    checkout_txs = create_transactions(odoo, provider_id, count, prefix + '-C')
+    callback_txs = create_transactions(odoo, provider_id, count, prefix + '-S')
+    before = scrape(odoo)
+
+    # submit_payment
+    txids = {}
+
+    def submit(reference):
+        def task():
+            redirect_url = odoo.json_rpc('/payment/ifthenpay/submit_payment', {
+                'provider_id': provider_id, 'tx_reference': reference,
+            })['redirect_url']
+            txids[reference] = redirect_url.rstrip('/').rsplit('/', 1)[-1]
+        return task
+    results['submit_payment'] = summarize(*run([submit(ref) for ref, _amount in checkout_txs], concurrency))
+
+    # iframe_callback, then the status polling
+    confirm_durations = []
+
+    def iframe_callback(reference, amount):
+        def task():
+            txid = txids[reference]
+            sim.pay(txid, notify=False)
+            started = time.perf_counter()
+            status, _body = odoo.get('/payment/ifthenpay/iframe_callback', {
+                'reference': reference, 'amount': amount, 'status': 'success', 'txid': txid,
+            })
+            if status != 200:
+                raise RuntimeError("iframe_callback returned %s" % status)
+            while time.perf_counter() - started < confirm_timeout:
+                result = odoo.json_rpc('/payment/ifthenpay/check_transaction_status', {'tx_reference': reference})
+                if result.get('status') == 'success':
+                    confirm_durations.append(time.perf_counter() - started)
+                    return
+                time.sleep(0.5)
+        return task
+    results['iframe_callback'] = summarize(*run(
+        [iframe_callback(ref, amount) for ref, amount in checkout_txs if ref in txids], concurrency,
+    ))
+    results['iframe_callback']['confirmed'] = len(confirm_durations)
+    results['iframe_callback'].update({
+        'confirm_p%s_ms' % rank: confirm_durations and round(percentile(confirm_durations, rank) * 1000, 2)
+        for rank in (50, 95, 99)
+    })
+
+    # s2s_callback
+    def s2s_callback(reference, amount):
+        def task():
+            status, _body = odoo.get('/payment/ifthenpay/s2s_callback', {
+                'reference': reference, 'amount': amount, 'apk': api_key,
+            })
+            if status != 200:
+                raise RuntimeError("s2s_callback returned %s" % status)
+        return task
+    results['s2s_callback'] = summarize(*run([s2s_callback(ref, amount) for ref, amount in callback_txs], concurrency))
+
+    # get_payment_methods_icons
+    def methods():
+        status, _body = odoo.get('/payment/ifthenpay/get_payment_methods_icons')
+        if status != 200:
+            raise RuntimeError("get_payment_methods_icons returned %s" % status)
+    results['get_payment_methods_icons'] = summarize(*run([methods] * count, concurrency))
+
+    after = scrape(odoo)
+    for route, result in results.items():
+        result['queries_per_request'] = queries_per_request(before, after, route)
+    return {'scenarios': results, 'memory': worker_memory()}
+
+
+def compare(results, baseline, tolerance):
+    """ Return the regressions of the results compared with the baseline, as messages. """
+    regressions = []
+    for scenario, result in results['scenarios'].items():
+        reference = baseline.get('scenarios', {}).get(scenario, {})
+        for metric, higher_is_better in COMPARED_METRICS:
+            value, expected = result.get(metric), reference.get(metric)
+            if value is None or not expected:
+                continue
+            change = (value - expected) / expected
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append("%s %s: %s (baseline %s, %+.0f%%)" % (scenario, metric, value, expected, change * 100))
+    rss, expected = results['memory'].get('rss_max_mb'), baseline.get('memory', {}).get('rss_max_mb')
+    if rss and expected and (rss - expected) / expected > tolerance:
+        regressions.append("memory rss_max_mb: %s (baseline %s)" % (rss, expected))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://localhost:8069', help="URL of the Odoo server.")
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--login', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--setup', action='store_true', help="Point the ifthenpay provider to the simulator.")
+    parser.add_argument('--api-key', default='BENCHMARK', help="APIToken of the provider, sent with the callbacks.")
+    parser.add_argument('--requests', type=int, default=100, help="Requests per scenario.")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--confirm-timeout', type=float, default=120,
+                        help="Seconds to wait for the status polling to confirm a payment.")
+    parser.add_argument('--simulator-host', default='127.0.0.1')
+    parser.add_argument('--simulator-port', type=int, default=8070)
+    parser.add_argument('--latency', type=float, default=50, help="Latency of the simulator, in milliseconds.")
+    parser.add_argument('--jitter', type=float, default=20, help="Jitter of the simulator, in milliseconds.")
+    parser.add_argument('--output', help="File to write the results to, as JSON.")
+    parser.add_argument('--baseline', help="Results to compare with, as JSON.")
+    parser.add_argument('--save-baseline', action='store_true', help="Write the results to the baseline file.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Accepted regression, as a share of the baseline.")
+    args = parser.parse_args()
+
+    sim = simulator.Simulator(store_url=args.url, latency=args.latency, jitter=args.jitter, seed=0)
+    server = simulator.make_server(sim, args.simulator_host, args.simulator_port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    odoo = Odoo(args.url, args.db, args.login, args.password)
+    if args.setup:
+        provider_id = setup(odoo, sim.base_url, args.api_key)
+    else:
+        provider_id = odoo.call('payment.provider', 'search', [('code', '=', 'ifthenpay')], limit=1)[0]
+
+    rate_limits = setup_rate_limits(odoo, provider_id)
+    try:
+        results = benchmark(odoo, sim, provider_id, args.api_key, args.requests, args.concurrency, args.confirm_timeout)
+    finally:
+        teardown_rate_limits(odoo, provider_id, rate_limits)
+    results['parameters'] = {
+        'requests': args.requests, 'concurrency': args.concurrency, 'latency': args.latency, 'jitter': args.jitter,
+    }
+    server.shutdown()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            f.write(output + '\n')
+    elif args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION %s" % regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
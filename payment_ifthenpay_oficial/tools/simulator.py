@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Local simulator of the ifthenpay API, to run the module without network access.
+
+It implements the endpoints called by the module (cmsintegration, Pinpay, available methods,
+transaction status and callback activation), a payment page standing for the Pinpay gateway, and
+sends the server-to-server callbacks back to Odoo once a payment is completed.
+
+Usage::
+
+    python3 simulator.py --port 8070 --store-url http://localhost:8069 --auto-pay 1
+
+then set the "API URL" of the ifthenpay provider (developer mode) to `http://localhost:8070` and
+save any APIToken: the simulator accepts all of them.
+
+Faults can be injected with `--latency`/`--jitter` (milliseconds), `--error-rate` (share of the
+calls answered with a 503, optionally restricted to `--error-endpoints`) and `--status-delay` (the
+status endpoint answers 404 until the payment is that many seconds old).
+
+The module only depends on the standard library so that it can also be imported, e.g. by the
+benchmark script, through `Simulator` and `make_server`.
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+from urllib.request import urlopen
+
+_logger = logging.getLogger('ifthenpay_simulator')
+
+ENDPOINTS = ('integration', 'pinpay', 'status', 'methods', 'callback_activation')
+
+# The payment methods offered by the simulated accounts: (entity, method, sub-entity).
+METHODS = (
+    ('MB', 'Multibanco', '999-999'),
+    ('MBWAY', 'MB WAY', 'SIM-001'),
+    ('CCARD', 'Credit card', 'SIM-002'),
+    ('PAYSHOP', 'Payshop', 'SIM-003'),
+)
+
+ICON = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="64" height="32" viewBox="0 0 64 32">'
+    '<rect width="64" height="32" rx="4" fill="#2f3e4e"/>'
+    '<text x="32" y="20" font-family="sans-serif" font-size="10" fill="#fff" text-anchor="middle">%s</text>'
+    '</svg>'
+)
+
+
+class Simulator:
+    """ The state of the simulated ifthenpay account and the fault injection settings. """
+
+    def __init__(self, store_url='http://localhost:8069', latency=0, jitter=0, error_rate=0.0,
+                 error_endpoints=ENDPOINTS, status_delay=0, auto_pay=0.0, pay_delay=1.0,
+                 default_method='', seed=None):
+        self.store_url = store_url.rstrip('/')
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+        self.error_rate = error_rate
+        self.error_endpoints = set(error_endpoints)
+        self.status_delay = status_delay
+        self.auto_pay = auto_pay
+        self.pay_delay = pay_delay
+        self.default_method = default_method
+        self.random = random.Random(seed)
+        self.base_url = None  # set once the server is bound
+        self.lock = threading.Lock()
+        self.callbacks = {}  # gateway key -> (callback URL template, anti-phishing key)
+        self.payments = {}  # transaction id -> payment
+        self.stats = {'requests': 0, 'errors': 0, 'callbacks': 0, 'callback_errors': 0}
+
+    # --- Fault injection ---
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+
+    def should_fail(self, endpoint):
+        with self.lock:
+            self.stats['requests'] += 1
+            fail = endpoint in self.error_endpoints and self.random.random() < self.error_rate
+            if fail:
+                self.stats['errors'] += 1
+        return fail
+
+    # --- API ---
+
+    def integration(self, token):
+        gateway_key = 'SIM-%s' % token[:8].upper()
+        return {
+            'storeName': "ifthenpay simulator",
+            'email': 'simulator@example.com',
+            'gatewayKey': gateway_key,
+            'expiryDays': '1',
+            'storeUrl': self.store_url,
+            'tokenApi': token,
+            'accountKeys': ';'.join('%s|%s' % (entity, sub_entity) for entity, _name, sub_entity in METHODS),
+            'paymentData': json.dumps({'defaultPaymentMethod': self.default_method}) if self.default_method else '{}',
+        }
+
+    def activate_callback(self, payload):
+        with self.lock:
+            self.callbacks[payload.get('chave')] = (payload.get('urlCb'), payload.get('apKey'))
+        return {'Status': 'OK', 'Message': "Callback activated"}
+
+    def methods(self):
+        return [{
+            'Entity': entity,
+            'Method': name,
+            'SmallImageUrl': '%s/img/%s.svg' % (self.base_url, entity.lower()),
+            'IsVisible': True,
+        } for entity, name, _sub_entity in METHODS]
+
+    def create_payment(self, gateway_key, payload):
+        txid = uuid.uuid4().hex[:20].upper()
+        payment = {
+            'txid': txid,
+            'gateway_key': gateway_key,
+            'reference': payload.get('id'),
+            'amount': payload.get('amount'),
+            'method': payload.get('selected_method') or 'CCARD',
+            'success_url': unquote(payload.get('success_url') or ''),
+            'error_url': unquote(payload.get('error_url') or ''),
+            'cancel_url': unquote(payload.get('btnCloseUrl') or ''),
+            'paid_date': None,
+        }
+        with self.lock:
+            self.payments[txid] = payment
+        if self.auto_pay and self.random.random() < self.auto_pay:
+            threading.Timer(self.pay_delay, self.pay, args=(txid,)).start()
+        return {
+            'PinCode': txid,
+            'PinpayUrl': '%s/pay/%s' % (self.base_url, txid),
+            'RedirectUrl': '%s/pay/%s' % (self.base_url, txid),
+        }
+
+    def status(self, txid):
+        payment = self.payments.get(txid)
+        if not payment or not payment['paid_date'] or time.time() - payment['paid_date'] < self.status_delay:
+            return None
+        return {
+            'TransactionId': txid,
+            'PaymentMethod': payment['method'],
+            'Amount': payment['amount'],
+            'OrderId': payment['reference'],
+            'Status': 'COMPLETED',
+        }
+
+    def pay(self, txid, notify=True):
+        """ Complete a payment and send its callback to Odoo.
+
+        :param str txid: The transaction id of the payment.
+        :param bool notify: Whether to send the callback, or only let the status endpoint know it.
+        :return: The payment, or None if it does not exist.
+        :rtype: dict
+        """
+        with self.lock:
+            payment = self.payments.get(txid)
+            if not payment:
+                return None
+            first = payment['paid_date'] is None
+            if first:
+                payment['paid_date'] = time.time()
+        if first and notify:
+            self.send_callback(payment)
+        return payment
+
+    def send_callback(self, payment):
+        url, apk = self.callbacks.get(payment['gateway_key'], (None, None))
+        if not url:
+            _logger.warning("No callback activated for gateway key %s", payment['gateway_key'])
+            return
+        url = url.replace('[AMOUNT]', quote(str(payment['amount']))) \
+                 .replace('[ORDER_ID]', quote(str(payment['reference']))) \
+                 .replace('[ANTI_PHISHING_KEY]', quote(str(apk or '')))
+        url += ('&' if '?' in url else '?') + urlencode({'txid': payment['txid']})
+        try:
+            with urlopen(url, timeout=30) as response:
+                response.read()
+            ok = True
+        except Exception as e:
+            _logger.warning("Callback of %s failed: %s", payment['reference'], e)
+            ok = False
+        with self.lock:
+            self.stats['callbacks' if ok else 'callback_errors'] += 1
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = 'ifthenpay-simulator'
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def simulator(self):
+        return self.server.simulator
+
+    def log_message(self, fmt, *args):
+        _logger.debug("%s - %s", self.address_string(), fmt % args)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if method == 'GET' and parts[:1] == ['pay']:
+            return self.payment_page(parts[1:], query)
+        if method == 'GET' and parts[:1] == ['img'] and len(parts) == 2:
+            entity = parts[1].rsplit('.', 1)[0].upper()
+            return self.respond(200, (ICON % entity).encode(), 'image/svg+xml')
+        if method == 'GET' and parts == ['stats']:
+            return self.respond_json(200, self.simulator.stats)
+
+        if method == 'POST' and len(parts) == 5 and parts[:3] == ['v2', 'cmsintegration', 'get']:
+            endpoint, handler = 'integration', lambda: self.simulator.integration(parts[3])
+        elif method == 'POST' and len(parts) == 3 and parts[:2] == ['gateway', 'pinpay']:
+            endpoint, handler = 'pinpay', lambda: self.simulator.create_payment(parts[2], self.read_json())
+        elif method == 'GET' and parts == ['gateway', 'transaction', 'status', 'get']:
+            endpoint, handler = 'status', lambda: self.simulator.status(query.get('transactionId'))
+        elif method == 'GET' and parts == ['gateway', 'methods', 'available']:
+            endpoint, handler = 'methods', self.simulator.methods
+        elif method == 'POST' and parts == ['endpoint', 'callback', 'activation']:
+            endpoint, handler = 'callback_activation', lambda: self.simulator.activate_callback(self.read_json())
+        else:
+            return self.respond_json(404, {'message': "Not found"})
+
+        self.simulator.delay()
+        if self.simulator.should_fail(endpoint):
+            return self.respond_json(503, {'message': "Simulated failure"})
+        result = handler()
+        if result is None:
+            return self.respond_json(404, {'message': "Not found"})
+        return self.respond_json(200, result)
+
+    def payment_page(self, parts, query):
+        payment = self.simulator.payments.get(parts[0]) if parts else None
+        if not payment:
+            return self.respond_json(404, {'message': "Not found"})
+        action = parts[1] if len(parts) > 1 else None
+        if action == 'confirm':
+            self.simulator.pay(payment['txid'])
+            return self.redirect(payment['success_url'].replace('[TRANSACTIONID]', payment['txid']))
+        if action == 'error':
+            return self.redirect(payment['error_url'].replace('[TRANSACTIONID]', payment['txid']))
+        if action == 'cancel':
+            return self.redirect(payment['cancel_url'].replace('[TRANSACTIONID]', payment['txid']))
+        body = (
+            '<!DOCTYPE html><html><head><meta charset="utf-8"><title>ifthenpay simulator</title></head>'
+            '<body><h1>%(reference)s</h1><p>%(amount)s EUR</p>'
+            '<a href="/pay/%(txid)s/confirm">Pay</a> | '
+            '<a href="/pay/%(txid)s/error">Fail</a> | '
+            '<a href="/pay/%(txid)s/cancel">Cancel</a></body></html>'
+        ) % payment
+        return self.respond(200, body.encode(), 'text/html; charset=utf-8')
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            return json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return {}
+
+    def redirect(self, location):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def respond_json(self, status, data):
+        self.respond(status, json.dumps(data).encode(), 'application/json')
+
+    def respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(simulator, host='127.0.0.1', port=8070):
+    """ Return an HTTP server serving the simulator, bound but not yet serving.
+
+    :param Simulator simulator: The simulated account.
+    :param str host: The interface to listen on.
+    :param int port: The port to listen on, 0 for any free port.
+    :return: The server.
+    :rtype: ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.simulator = simulator
+    simulator.base_url = 'http://%s:%s' % (host, server.server_address[1])
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8070)
+    parser.add_argument('--store-url', default='http://localhost:8069', help="URL of the Odoo database.")
+    parser.add_argument('--latency', type=float, default=0, help="Latency added to the API calls, in milliseconds.")
+    parser.add_argument('--jitter', type=float, default=0, help="Random variation of the latency, in milliseconds.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of the API calls answered with a 503.")
+    parser.add_argument('--error-endpoints', default=','.join(ENDPOINTS), help="Endpoints that may fail.")
+    parser.add_argument('--status-delay', type=float, default=0,
+                        help="Seconds after the payment during which the status endpoint answers 404.")
+    parser.add_argument('--auto-pay', type=float, default=0.0,
+                        help="Share of the payments completed without visiting the payment page.")
+    parser.add_argument('--pay-delay', type=float, default=1.0, help="Seconds before an automatic payment.")
+    parser.add_argument('--default-method', default='', help="Default payment method of the integration.")
+    parser.add_argument('--seed', type=int, help="Seed of the random generator, for reproducible runs.")
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(message)s')
+    simulator = Simulator(
+        store_url=args.store_url, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        error_endpoints=[endpoint.strip() for endpoint in args.error_endpoints.split(',') if endpoint.strip()],
+        status_delay=args.status_delay, auto_pay=args.auto_pay, pay_delay=args.pay_delay,
+        default_method=args.default_method, seed=args.seed,
+    )
+    server = make_server(simulator, args.host, args.port)
+    _logger.info("ifthenpay simulator listening on %s", simulator.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+
+
+@contextmanager
+def shared_state_cursor(env):
+    """ Yield a new cursor to update state shared between the workers.
+
+    The cursor runs in READ COMMITTED so that concurrent upserts of the same row wait for each other
+    instead of failing with a serialization error, and it is committed on exit so that the update
+    survives a rollback of the current transaction.
+
+    :param odoo.api.Environment env: The current environment.
+    :return: The cursor.
+    :rtype: odoo.sql_db.Cursor
+    """
+    with env.registry.cursor() as cr:
+        # in test mode the cursor shares the transaction of the test, which is already started
+        if not env.registry.in_test_mode():
+            cr.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        yield cr
@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+from . import payment_ifthenpay_settlement_import
+from . import payment_ifthenpay_transaction_export
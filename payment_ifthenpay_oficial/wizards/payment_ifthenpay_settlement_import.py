@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from odoo import fields, models
+
+
+class PaymentIfthenpaySettlementImport(models.TransientModel):
+    _name = 'payment.ifthenpay.settlement.import'
+    _description = "Import an ifthenpay Settlement File"
+
+    provider_id = fields.Many2one(
+        'payment.provider', required=True, domain=[('code', '=', 'ifthenpay')],
+        default=lambda self: self.env['payment.provider'].search([
+            ('code', '=', 'ifthenpay'), ('company_id', '=', self.env.company.id),
+        ], limit=1),
+    )
+    file = fields.Binary(string="Settlement File", required=True)
+    file_name = fields.Char()
+
+    def action_import(self):
+        """ Store the file and open the settlement import, which is processed in the background.
+
+        :return: The action opening the settlement import.
+        :rtype: dict
+        """
+        self.ensure_one()
+        settlement = self.env['payment.ifthenpay.settlement']._create_from_file(
+            self.provider_id, self.file_name, self.file,
+        )
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': settlement._name,
+            'res_id': settlement.id,
+            'view_mode': 'form',
+        }
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from urllib.parse import urlencode
+
+from odoo import fields, models
+
+
+class PaymentIfthenpayTransactionExport(models.TransientModel):
+    _name = 'payment.ifthenpay.transaction.export'
+    _description = "Export ifthenpay Transactions"
+
+    date_from = fields.Date(string="From", default=lambda self: fields.Date.context_today(self) - timedelta(days=30))
+    date_to = fields.Date(string="To", default=fields.Date.context_today)
+    state = fields.Selection(
+        selection=lambda self: self.env['payment.transaction']._fields['state']._description_selection(self.env),
+        string="Status",
+        help="Leave empty to export the transactions in all states.",
+    )
+    payment_method_ids = fields.Many2many(
+        'payment.method', string="Payment Methods", help="Leave empty to export all the payment methods.",
+    )
+
+    def action_export(self):
+        """ Download the transactions matching the filters, streamed by the export route.
+
+        :return: The action downloading the CSV file.
+        :rtype: dict
+        """
+        self.ensure_one()
+        params = {
+            'date_from': self.date_from and fields.Date.to_string(self.date_from) or '',
+            'date_to': self.date_to and fields.Date.to_string(self.date_to) or '',
+            'states': self.state or '',
+            'methods': ','.join(self.payment_method_ids.mapped('code')),
+        }
+        return {
+            'type': 'ir.actions.act_url',
+            'url': f'/payment/ifthenpay/transactions/export?{urlencode(params)}',
+            'target': 'self',
+        }